@@ -2,7 +2,99 @@
 import logbin2018 as lb
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import stats
+from scipy import stats, optimize
+from running_statistics import Running_Statistics, histogram_moments
+
+def logbin_avalanches(avalanche_data, scale):
+    # log bins avalanche size data, or the histogram of a streamed run
+    if isinstance(avalanche_data, Running_Statistics):
+        return lb.logbin_counts(avalanche_data.s_counts, scale=scale, zeros=True)
+    return lb.logbin(avalanche_data, scale=scale, zeros=True)
+
+def logbin_avalanches_many(avalanche_data, scale):
+    # log bins a list of avalanche size data sets in one call
+    counts = [data.s_counts if isinstance(data, Running_Statistics) else np.bincount(data)
+              for data in avalanche_data]
+    return lb.logbin_counts_many(counts, scale=scale, zeros=True)
+
+def avalanche_moments(avalanche_data, k_max):
+    # moments k=0..k_max of avalanche size data, or of a streamed run, from
+    # the histogram of the data so no per k copies of the data are made
+    if isinstance(avalanche_data, Running_Statistics):
+        return avalanche_data.moments_s(k_max)
+    avalanche_data = np.asarray(avalanche_data)
+    if avalanche_data.dtype.kind == 'f': # sizes stored as floats by older runs
+        avalanche_data = avalanche_data.astype(np.int64)
+    counts = np.bincount(avalanche_data)
+    return np.float64(histogram_moments(counts, k_max) / len(avalanche_data))
+
+def avalanche_moment(avalanche_data, k):
+    # kth moment of avalanche size data, or of a streamed run
+    return avalanche_moments(avalanche_data, k)[k]
+
+def moment_exponents(L, moments, k_range=range(1, 5), fit_sizes=3):
+    '''
+    moment_exponents: estimates the critical exponents D and t_s by moment
+    analysis. <s^k> ~ L^{D(1+k-t_s)} is fitted for each k using the largest
+    system sizes, then the fitted gradients are fitted against k. Every leading
+    index of moments (e.g. runs or resamples) is fitted at once.
+    Args:
+        L: array-like, system sizes.
+        moments: array-like, moments indexed [..., k, i] for system size L[i].
+        k_range: values of k to use.
+        fit_sizes: int, number of the largest system sizes to fit.
+    Returns:
+        D, t_s: estimated critical exponents.
+    '''
+    k = np.array(k_range, np.float64)
+    x = np.log(np.asarray(L, np.float64)[-fit_sizes:])
+    y = np.log(np.asarray(moments)[..., list(k_range), -fit_sizes:])
+    # least squares gradients of log moment against log L for every k
+    x = x - np.mean(x)
+    gradients = np.sum(x * y, axis=-1) / np.sum(x**2)
+    # gradient = D(1+k-t_s) = D k + D(1-t_s)
+    k_centred = k - np.mean(k)
+    m = np.sum(k_centred * gradients, axis=-1) / np.sum(k_centred**2)
+    c = np.mean(gradients, axis=-1) - m * np.mean(k)
+    return m, 1 - c/m
+
+def avalanche_distribution(avalanche_data):
+    # observed avalanche sizes and their frequencies
+    if isinstance(avalanche_data, Running_Statistics):
+        return avalanche_data.s_distribution()
+    return np.unique(avalanche_data, return_counts=True)
+
+def collapse_quality(log_x, log_y, log_L, D, t_s, n_points=200):
+    '''
+    collapse_quality: spread of the rescaled log binned pdfs of all system sizes
+    for a trial (D, t_s). Each curve is linearly interpolated in log-log space
+    onto a common grid of log(s/L^D) and the variance across the curves which
+    cover each grid point is averaged, so an evaluation costs O(total bins).
+    Args:
+        log_x, log_y: lists of log binned log(s) and log(P(s;L)) of each system size.
+        log_L: array-like, log of the system sizes.
+        D, t_s: trial critical exponents.
+        n_points: int, size of the common grid.
+    Returns:
+        quality: mean variance of log(s^t_s P(s;L)) across system sizes, inf
+                 if fewer than two curves overlap.
+    '''
+    # curves with no log binned points are left out
+    curves = [(x, y, l) for x, y, l in zip(log_x, log_y, log_L) if len(x) > 0]
+    if len(curves) < 2:
+        return np.inf
+    u = [x - D * l for x, y, l in curves] # log(s/L^D)
+    v = [y + t_s * x for x, y, l in curves] # log(s^t_s P(s;L))
+    lower = sorted(u_i[0] for u_i in u)[1]
+    upper = sorted(u_i[-1] for u_i in u)[-2]
+    if upper <= lower:
+        return np.inf
+    grid = np.linspace(lower, upper, n_points)
+    values = np.array([np.interp(grid, u_i, v_i, left=np.nan, right=np.nan) for u_i, v_i in zip(u, v)])
+    covered = np.sum(~np.isnan(values), axis=0)
+    with np.errstate(invalid='ignore'):
+        variance = np.nanvar(values[:, covered > 1], axis=0)
+    return np.mean(variance)
 
 class Avalanche_Probability_Analysis:
     
@@ -14,9 +106,12 @@ class Avalanche_Probability_Analysis:
         plot_log_binned_pdf: plots the log binned avalanche size pdfs for specified
                              system sizes and performs a data collapse using
                              specified critical exponents.
+        optimise_collapse: finds the exponents D, t_s giving the best data collapse.
         plot_pdf: plots the unbinned avalanche size pdfs.
         plot_moments: plots the moments for specified system sizes and carries out
                       moment analysis to estimate critical exponents.
+    recurrent_s_data may hold the recurrent avalanche size arrays or the 
+    Running_Statistics accumulators of a streamed run for each system size.
     '''
     
     def __init__(self, L, N, t_s, D, a, recurrent_s_data):
@@ -27,6 +122,7 @@ class Avalanche_Probability_Analysis:
         self.t_s = t_s
         self.D = D
         self.a = a
+        self.binned = {} # log binned pdfs of every system size, by scale
                                  
     def prob_binning(self, avalanche_data, scale, L):
         '''
@@ -42,7 +138,7 @@ class Avalanche_Probability_Analysis:
             y_scaled: array_like, data collapse scaled log binned y values.
         '''
         # carries out log binning using provided module
-        x, y = lb.logbin(avalanche_data, scale=scale, zeros=True)
+        x, y = logbin_avalanches(avalanche_data, scale)
         x_scaled = [] # array to hold scaled x values
         y_scaled = [] # array to hold scaled y values
         
@@ -56,6 +152,40 @@ class Avalanche_Probability_Analysis:
         
         return x, y, x_scaled, y_scaled
     
+    def log_binned(self, scale):
+        # log binned pdfs of every system size, binned once for each scale
+        if scale not in self.binned:
+            self.binned[scale] = logbin_avalanches_many(self.recurrent_s_data, scale)
+        return self.binned[scale]
+    
+    def optimise_collapse(self, s_min=10, scale=None):
+        '''
+        optimise_collapse: searches for the critical exponents which minimise
+        the spread of the data collapse of the log binned pdfs over all system
+        sizes (see collapse_quality), starting from the current D and t_s.
+        The pdfs are binned once and only rescaled for each trial.
+        Args:
+            s_min: smallest avalanche size to include, to exclude the small s
+                   region which does not collapse.
+            scale: float, log binning scale, defaults to a.
+        Returns:
+            D, t_s: the optimised exponents, which replace self.D and self.t_s.
+        '''
+        if scale is None:
+            scale = self.a
+        log_x = []
+        log_y = []
+        for x, y in self.log_binned(scale):
+            kept = (x >= s_min) & (y > 0)
+            log_x.append(np.log(x[kept]))
+            log_y.append(np.log(y[kept]))
+        log_L = np.log(self.L)
+        quality = lambda exponents: collapse_quality(log_x, log_y, log_L, *exponents)
+        solution = optimize.minimize(quality, [self.D, self.t_s], method='Nelder-Mead')
+        self.D, self.t_s = solution.x
+        print("Data collapse optimised: D={}, t_s={}".format(self.D, self.t_s))
+        return self.D, self.t_s
+    
     def plot_log_binned_pdf(self):
     
         fig1, ax1 = plt.subplots()
@@ -87,13 +217,12 @@ class Avalanche_Probability_Analysis:
     
     def moment(self, data, k):
         # calculate the kth moment of a set of data, for each value of L required
-        
-        moment_data = []
-        for i, l in enumerate(self.L):
-            power = np.power(np.float64(data[i]), k)
-            moment = np.sum(power)/len(data[i])
-            moment_data.append(moment)
-        return moment_data
+        return list(self.moments(data, k)[k])
+
+    def moments(self, data, k_max):
+        # calculate moments k=0..k_max of a set of data for each value of L,
+        # moment_data[k][i] is the kth moment for system size L[i]
+        return np.array([avalanche_moments(data[i], k_max) for i, l in enumerate(self.L)]).T
     
     def moment_theoretical(self, k):
         moment_th_data = []
@@ -110,13 +239,13 @@ class Avalanche_Probability_Analysis:
         freq_data = []
         
         for i, l in enumerate(self.L):
-            val, freq = np.unique(self.recurrent_s_data[i], return_counts=True)
+            val, freq = avalanche_distribution(self.recurrent_s_data[i])
             val_data.append(val)
             freq_data.append(freq)
             
         fig1, ax1 = plt.subplots()
         for i, l in enumerate(self.L):
-            ax1.loglog(val_data[i], freq_data[i]/len(self.recurrent_s_data[i]), linestyle='', marker='.', label='L: {}'.format(l))
+            ax1.loglog(val_data[i], freq_data[i]/np.sum(freq_data[i]), linestyle='', marker='.', label='L: {}'.format(l))
         
         ax1.set_xlabel(r'$s$')
         ax1.set_ylabel(r'$P(s;L)$')
@@ -134,8 +263,9 @@ class Avalanche_Probability_Analysis:
         log_moments = []
         exponent_values = []
         
+        moments = self.moments(self.recurrent_s_data, k_range[-1])
         for i in k_range:
-            moment = self.moment(self.recurrent_s_data, i)
+            moment = moments[i]
             log_moments.append(np.log(moment))
             # calculate line of best fit using only the three largest system sizes
             linregsoln = stats.linregress(log_L[-3:], np.log(moment)[-3:])
@@ -171,6 +301,9 @@ class Avalanche_Probability_Analysis_Multi:
     probability distributions for over multiple runs to calculate mean/sd
     values of calculated quantities (here: critical exponents).
     Loads data generated from run_oslo_multi.py
+    Important methods:
+        exponents_multi: moment analysis of each run, averaged over the runs.
+        log_binned_pdfs: log binned avalanche size pdfs of every run.
     '''
     
     def __init__(self, L, s_data_multi):
@@ -180,36 +313,17 @@ class Avalanche_Probability_Analysis_Multi:
         
     def moment(self, data, k):
         # calculates kth moment of a set of data
-        moment_data = []
-        for i, l in enumerate(self.L):
-            power = np.power(np.float64(data[i]), k)
-            moment = np.sum(power)/len(data[i])
-            moment_data.append(moment)
-        return moment_data
+        return list(self.moments(data, k)[k])
+
+    def moments(self, data, k_max):
+        # calculates moments k=0..k_max of a set of data, indexed [k][i]
+        return np.array([avalanche_moments(data[i], k_max) for i, l in enumerate(self.L)]).T
     
     def exponents(self, data):
         
         # calculates the critical exponents from a set of data
         
-        k_range = range(1, 5)
-        log_L = [np.log(l) for l in self.L]
-        log_moments = []
-        exponent_values = []
-        
-        for i in k_range:
-            moment = self.moment(data, i)
-            log_moments.append(np.log(moment))
-            linregsoln = stats.linregress(log_L[-3:], np.log(moment)[-3:])
-            exponent_values.append(linregsoln[0])
-        
-        linregsoln = stats.linregress(k_range, exponent_values)
-        m = linregsoln[0]
-        c = linregsoln[1]
-        
-        D = m
-        t_s = 1 - c/m
-        
-        return D, t_s
+        return moment_exponents(self.L, self.moments(data, 4))
         
     def exponents_multi(self):
         
@@ -235,4 +349,19 @@ class Avalanche_Probability_Analysis_Multi:
         
         
         
-    
\ No newline at end of file
+    
+        
+    def log_binned_pdfs(self, scale=1.2):
+        '''
+        log_binned_pdfs: log bins the avalanche size data of every system size
+        of every run in one call.
+        Args:
+            scale: float, log binning scale.
+        Returns:
+            binned: list over runs of lists over system sizes of (x, y), the
+                    log binned x and y values.
+        '''
+        data = [s_l for s in self.s_data_multi for s_l in s]
+        binned = logbin_avalanches_many(data, scale)
+        n = len(self.L)
+        return [binned[i:i + n] for i in range(0, len(binned), n)]
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import warnings
+from timeit import default_timer as timer
+import numpy as np
+import oslo
+import oslo_kernel
+from running_statistics import Running_Statistics
+from avalanche_probability_analysis import logbin_avalanches, avalanche_moments, moment_exponents
+from height_analysis import fit_scaling_correction
+from crossover_analysis import moving_average
+
+# system sizes and iterations benchmarked by default, the python model is
+# given fewer iterations as it is much slower
+default_L = [4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048]
+default_N = {'python': 10**4, 'python_sweep': 10**3, 'cpp': 10**6}
+engines = tuple(default_N) # engines which can be benchmarked
+
+def new_system(engine, L, p, seed):
+    # system of the given engine, see engines
+    if engine == 'cpp':
+        return oslo_kernel.Kernel_System(L, p, seed=seed)
+    if engine == 'python_sweep':
+        return oslo.System(L, p, engine='sweep', seed=seed)
+    return oslo.System(L, p, seed=seed)
+
+def time_call(function, repeat=3):
+    # best wall time of repeat calls of function, and its last result
+    best = np.inf
+    for r in range(repeat):
+        start = timer()
+        result = function()
+        best = min(best, timer() - start)
+    return best, result
+
+def benchmark_simulation(engine, L, N, p=0.5, seed=0, repeat=3):
+    '''
+    benchmark_simulation: times iterate(N) of one system in the stationary
+    state. The system is brought there once, untimed, with fast_forward so
+    that the transient of large systems is not run, and each repeat then
+    times N further iterations continuing from where the last one stopped.
+    Args:
+        engine: 'python', 'python_sweep' or 'cpp'.
+        L: system size.
+        N: number of iterations.
+        p: probability of a threshold gradient of 1.
+        seed: seed of the system.
+        repeat: number of runs, the fastest is reported.
+    Returns:
+        result: dict of the parameters, time in seconds, grains and topples
+                per second.
+    '''
+
+    system = new_system(engine, L, p, seed)
+    system.iterate(0, fast_forward=True) # builds the pile and runs its burn-in
+    seconds = np.inf
+    for r in range(repeat):
+        start = timer()
+        system.iterate(N, resume=True)
+        run_seconds = timer() - start
+        if run_seconds < seconds:
+            # every toppling adds one to the avalanche size
+            seconds = run_seconds
+            topples = int(np.sum(system.avalanche_sizes, dtype=np.int64))
+    return {'benchmark': 'simulation', 'engine': engine, 'L': L, 'N': N, 'p': p,
+            'seconds': seconds, 'grains_per_s': N / seconds, 'topples': topples,
+            'topples_per_s': topples / seconds}
+
+def analysis_stages(L, recurrent_h_data, recurrent_s_data, W=25):
+    # analysis stages to time, each a function of no arguments
+    mean_h = np.array([np.mean(h) for h in recurrent_h_data])
+    moments = np.array([avalanche_moments(s, 4) for s in recurrent_s_data]).T
+    return {
+        'logbin': lambda: [logbin_avalanches(s, 1.2) for s in recurrent_s_data],
+        'moments': lambda: [avalanche_moments(s, 4) for s in recurrent_s_data],
+        'moment_exponents': lambda: moment_exponents(L, moments),
+        'scaling_correction': lambda: fit_scaling_correction(L, mean_h),
+        'smoothing': lambda: [moving_average(h, W) for h in recurrent_h_data],
+        'running_statistics': lambda: [Running_Statistics().update(h, s)
+                                       for h, s in zip(recurrent_h_data, recurrent_s_data)],
+    }
+
+def benchmark_analysis(L, N, p=0.5, seed=0, repeat=3):
+    '''
+    benchmark_analysis: times each analysis stage on N recurrent samples of
+    each system size, simulated with the compiled kernel where available.
+    Args:
+        L: array-like, system sizes.
+        N: number of recurrent samples of each system size.
+        p: probability of a threshold gradient of 1.
+        seed: seed of the simulations.
+        repeat: number of runs of each stage, the fastest is reported.
+    Returns:
+        results: list of dicts of the stage, time in seconds and samples per second.
+    '''
+
+    engine = 'cpp' if oslo_kernel.available() else 'python'
+    recurrent_h_data, recurrent_s_data = [], []
+    for l in L:
+        system = new_system(engine, l, p, seed)
+        system.iterate(N, fast_forward=True)
+        recurrent_h_data.append(system.heights)
+        recurrent_s_data.append(system.avalanche_sizes)
+    samples = N * len(L)
+    results = []
+    for stage, function in analysis_stages(L, recurrent_h_data, recurrent_s_data).items():
+        seconds, result = time_call(function, repeat)
+        results.append({'benchmark': 'analysis', 'stage': stage, 'L': list(L), 'N': N, 'p': p,
+                        'seconds': seconds, 'samples_per_s': samples / seconds})
+    return results
+
+def machine_info():
+    # description of the machine and code the benchmarks were run on
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': commit, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+def result_key(result):
+    # identifies the same benchmark in two result files
+    return json.dumps({key: value for key, value in result.items()
+                       if key in ('benchmark', 'engine', 'stage', 'L', 'N', 'p')}, sort_keys=True)
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    compare: prints the speed of each benchmark relative to a baseline run.
+    Args:
+        results: list of benchmark results.
+        baseline: list of benchmark results of an earlier run.
+        tolerance: fractional slowdown reported as a regression.
+    Returns:
+        regressions: list of (result, speedup) of the benchmarks slower than
+                     the baseline by more than tolerance.
+    '''
+
+    baseline = {result_key(result): result for result in baseline}
+    regressions = []
+    print('Speedup relative to baseline:')
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        speedup = old['seconds'] / result['seconds']
+        name = result.get('engine', result.get('stage'))
+        L = result['L'] if result['benchmark'] == 'simulation' else '{}..{}'.format(result['L'][0], result['L'][-1])
+        flag = ''
+        if speedup < 1 - tolerance:
+            regressions.append((result, speedup))
+            flag = '  REGRESSION'
+        print('    {} {} L={} N={} p={}: {:.2f}x{}'.format(result['benchmark'], name, L,
+                                                         result['N'], result['p'], speedup, flag))
+    return regressions
+
+def run_benchmarks(engines=engines, L=default_L, N=None, p=[0.5], analysis_N=10**5,
+                   repeat=3, seed=0):
+    '''
+    run_benchmarks: runs the simulation benchmarks of every engine over the
+    grid of L, N and p, then the analysis benchmarks.
+    Args:
+        engines: engines to benchmark, unavailable engines are skipped.
+        L: array-like, system sizes.
+        N: array-like, numbers of iterations, default default_N of each engine.
+        p: array-like, threshold probabilities.
+        analysis_N: number of recurrent samples for the analysis benchmarks,
+                    0 skips them.
+        repeat: number of runs of each benchmark, the fastest is reported.
+        seed: seed of the simulations.
+    Returns:
+        results: list of dicts, one per benchmark.
+    '''
+
+    results = []
+    for engine in engines:
+        if engine == 'cpp' and not oslo_kernel.available():
+            warnings.warn('Compiled Oslo kernel not available, skipping cpp benchmarks.')
+            continue
+        for n in (N or [default_N[engine]]):
+            for p_value in p:
+                for l in L:
+                    result = benchmark_simulation(engine, l, n, p_value, seed, repeat)
+                    print('{} L={} N={} p={}: {:.3f} s, {:.3g} grains/s, {:.3g} topples/s'.format(
+                          engine, l, n, p_value, result['seconds'], result['grains_per_s'],
+                          result['topples_per_s']))
+                    results.append(result)
+    if analysis_N:
+        for p_value in p:
+            for result in benchmark_analysis(L, analysis_N, p_value, seed, repeat):
+                print('{} L={}..{} N={} p={}: {:.3f} s, {:.3g} samples/s'.format(
+                      result['stage'], L[0], L[-1], analysis_N, p_value, result['seconds'],
+                      result['samples_per_s']))
+                results.append(result)
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks the Oslo model engines and analysis stages.')
+    parser.add_argument('--engines', nargs='+', choices=engines, default=['python', 'cpp'])
+    parser.add_argument('--L', type=int, nargs='+', default=default_L, help='system sizes')
+    parser.add_argument('--N', type=int, nargs='+', help='iterations, default depends on the engine')
+    parser.add_argument('--p', type=float, nargs='+', default=[0.5], help='threshold probabilities')
+    parser.add_argument('--analysis-N', type=int, default=10**5,
+                        help='recurrent samples per system size for the analysis benchmarks, 0 skips them')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='data/benchmarks.json', help='JSON file for the results')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.engines, args.L, args.N, args.p, args.analysis_N, args.repeat, args.seed)
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'machine': machine_info(), 'results': results}, f, indent=1)
+    print('Results written to {}.'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy as np
+
+def save_checkpoint(path, state):
+    '''
+    save_checkpoint: writes the state of a run to a .npz checkpoint file. The
+    file is written to a temporary name first and then moved into place, so
+    a run killed while saving leaves the previous checkpoint intact.
+    Args:
+        path: checkpoint file name.
+        state: dict of arrays and scalars to save.
+    '''
+    
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(temporary, path)
+
+def load_checkpoint(path):
+    '''
+    load_checkpoint: reads a checkpoint written by save_checkpoint.
+    Args:
+        path: checkpoint file name.
+    Returns:
+        state: dict of arrays, scalars are returned as 0-d arrays.
+    '''
+    
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+def seed_record(seed):
+    # JSON description of the SeedSequence a run was seeded from, from which
+    # the run can be repeated with np.random.SeedSequence(entropy, spawn_key=spawn_key)
+    return json.dumps({'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)})
+
+def check_checkpoint(state, **expected):
+    # checks that a checkpoint was written by a run with the same parameters
+    for key, value in expected.items():
+        if state[key].item() != value:
+            raise ValueError('Checkpoint was written with {}={}, not {}.'.format(
+                key, state[key].item(), value))
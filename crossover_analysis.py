@@ -1,13 +1,42 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import matplotlib.pyplot as plt
+from decimate import plot_series
 #from run_oslo import Run
 
+def moving_average(data, W):
+    '''
+    moving_average: centred running average of data over a window of 2W+1
+    points, taken as zero beyond the ends of the data, as np.convolve with
+    np.ones(2W+1)/(2W+1) and mode='same'. Computed from differences of the
+    cumulative sum, so the cost does not depend on W. The cumulative sum of 
+    integer data is exact.
+    Args:
+        data: array-like, time series.
+        W: int, half width of the window.
+    Returns:
+        average: array of the same length as data.
+    '''
+    data = np.asarray(data)
+    n = len(data)
+    if n < 2 * W + 1: # np.convolve returns the longer of the two inputs
+        return np.convolve(data, np.ones((2 * W + 1,)) / (2 * W + 1), mode='same')
+    dtype = np.int64 if data.dtype.kind in 'biu' else np.float64
+    cumulative = np.zeros(n + 1, dtype)
+    np.cumsum(data, out=cumulative[1:])
+    window = np.empty(n, dtype)
+    # windows which overlap the start, lie within, and overlap the end of the data
+    window[:W] = cumulative[W + 1:2 * W + 1]
+    np.subtract(cumulative[2 * W + 1:], cumulative[:n - 2 * W], out=window[W:n - W])
+    window[n - W:] = cumulative[n] - cumulative[n - 2 * W:n - W]
+    return window / (2 * W + 1)
+
 class Crossover_Analysis:
     '''
     Crossover_Analysis: class for carrying out analysis of the crossover time
     and plotting basic time series of the oslo model. Loads data that has already 
     been generated using the run_oslo.py script.
+    The smoothed and scaled height series are only computed when first used.
     Important methods:
         plot_heights: plots the (un)processed heights as a time series for the
                       specified system sizes and performs a data collapse.
@@ -15,41 +44,53 @@ class Crossover_Analysis:
                         alongside the theoretical crossover time.
     '''
 
-    def __init__(self, L, N, h_data, t_c_data, t_c_th_data):
+    def __init__(self, L, N, h_data, t_c_data, t_c_th_data, W=25):
         
         self.L = L # array-like, system sizes to investigate
         self.N = N # number of iterations to run for
         self.h_data = h_data 
-        self.N_scaled_list = []
         self.t_c_data = t_c_data
         self.t_c_th_data = t_c_th_data
-        self.processed_heights_list = []
-        self.processed_heights_scaled = []
-        
-        for i, l in enumerate(self.L):
-            # unscaled processed heights and scaled processed heights for data collapse
-            ph, ns, phs = self.processed_heights(self.h_data[i], l)
-            self.processed_heights_list.append(ph)
-            self.N_scaled_list.append(ns)
-            self.processed_heights_scaled.append(phs)
+        self.W = W # half width of the time averaging window
+        self.processed = None # processed heights of each system size, once computed
+    
+    def process(self):
+        # unscaled processed heights and scaled processed heights for data
+        # collapse of every system size, computed on first use
+        if self.processed is None:
+            self.processed = [self.processed_heights(self.h_data[i], l) for i, l in enumerate(self.L)]
+        return self.processed
+    
+    @property
+    def processed_heights_list(self):
+        return [ph for ph, ns, phs in self.process()]
+    
+    @property
+    def N_scaled_list(self):
+        return [ns for ph, ns, phs in self.process()]
+    
+    @property
+    def processed_heights_scaled(self):
+        return [phs for ph, ns, phs in self.process()]
         
     def processed_heights(self, data, L):
         
-        W = 25
-        # carry out time averaging of system heights using a convolution 
-        processed_heights = np.convolve(data, np.ones((2 * W + 1,)) / (2 * W + 1), 
-                                           mode='same')
+        W = self.W
+        # carry out time averaging of system heights using a running average
+        processed_heights = moving_average(data, W)
         # remove the end of the temporally smoothed height for edge effects
-        processed_heights = processed_heights[:-W]
+        processed_heights = processed_heights[:-W] if W > 0 else processed_heights
         # define a scaled height history h/L
-        processed_heights_scaled = [a / L for a in processed_heights]
+        processed_heights_scaled = processed_heights / L
         # define a scaled total iteration number N/L^2
-        N_scaled = [a / (L**2) for a in range(len(processed_heights))]
+        N_scaled = np.arange(len(processed_heights)) / L**2
         
         return processed_heights, N_scaled, processed_heights_scaled
         
     def plot_heights(self):
         
+        # time series are decimated to the width of the axes before plotting
+        
         fig1, ax1 = plt.subplots()
         ax1.grid()
         fig2, ax2 = plt.subplots()
@@ -64,32 +105,33 @@ class Crossover_Analysis:
         for i, l in enumerate(self.L):
             
             # plot unprocessed system height time series 
-            ax1.plot(range(len(self.h_data[i])), self.h_data[i], label=l)
+            plot_series(ax1, self.h_data[i], label=l)
             ax1.set_xlabel(r'$t$')
             ax1.set_ylabel(r'$h(t;L)$')
             #ax1.legend(loc='best')
             
             # plot processed system height time series
-            ax2.plot(range(len(self.processed_heights_list[i])), self.processed_heights_list[i], label=l)
+            plot_series(ax2, self.processed_heights_list[i], label=l)
             ax2.set_xlabel(r'$t$')
             ax2.set_ylabel(r'$\tilde{h}(t;L)$')
             #ax2.legend(loc='best')
             
             # plot processed, x axis scaled system height time series
-            ax3.plot(range(len(self.processed_heights_scaled[i])), self.processed_heights_scaled[i], label=l)
+            plot_series(ax3, self.processed_heights_scaled[i], label=l)
             ax3.set_xlabel(r'$t$')
             ax3.set_ylabel(r'$\tilde{h}(t;L)/L$')
             #ax3.legend(loc='best')
             
             # plot data collapse of system height time series
-            ax4.plot(self.N_scaled_list[i], self.processed_heights_scaled[i], label=l)
+            plot_series(ax4, self.processed_heights_scaled[i], self.N_scaled_list[i], 
+                        xlim=(0, 5), label=l)
             ax4.set_ylabel(r'$\tilde{h}(t;L)/L$')
             ax4.set_xlabel(r'$t/L^2$')
             #ax4.legend(loc='best')
-            ax4.set_xlim(0,5)
             
             # log-log plot of data collapse showing transient phase follows a x^0.5 trend
-            ax5.plot(self.N_scaled_list[i], self.processed_heights_scaled[i], label=l)
+            plot_series(ax5, self.processed_heights_scaled[i], self.N_scaled_list[i], 
+                        log=True, label=l)
             ax5.set_ylabel(r'$\tilde{h}(t;L)/L$')
             ax5.set_xlabel(r'$t/L^2$')
             #ax4.legend(loc='best')
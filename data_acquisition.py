@@ -1,56 +1,74 @@
 # -*- coding: utf-8 -*-
+import argparse
 import oslo as oslo
-from timeit import default_timer as timer
+import oslo_kernel
 import numpy as np
+from timeit import default_timer as timer
+from data_store import Data_Store, store_path
+from run_oslo import check_mode, run_jobs
 
-def acquire_avalanche_data(L, N):
+def acquire_system(engine, l, N, p, root, directory):
+    # runs one system size into its data store, returning the run time
+    start = timer()
+    seed_l = np.random.SeedSequence(root.entropy, spawn_key=(0, l))
+    store = Data_Store.create(store_path(directory, l, N), L=l, p=p, N=N, 
+                              seed=root.entropy, spawn_key=[0, l], t_c=None)
+    if engine == 'cpp':
+        system = oslo_kernel.Kernel_System(l, p, seed=seed_l)
+    else:
+        system = oslo.System(l, p, seed=seed_l)
+    system.iterate(N, stream=True, store=store)
+    return timer() - start
+
+def acquire_data(L, N, p=0.5, seed=None, directory='data/oslo_store', engine='python', workers=None):
     
     '''
-    acquire_avalanche_data: acquires and saves avalanche size time series
-    for recurrent phase.
-    produces file of form: 'avalanche_sizes_L_N.csv'.
+    acquire_data: acquires and saves the avalanche size and system height time
+    series for the recurrent phase. The data is appended to a data store as the
+    model runs, so the full time series is never held in memory.
+    produces a store directory of form: 'oslo_L_N', read with data_store.Data_Store.
     Args: 
-        L: system size.
-        N: number of avalanches/number of iterations model runs for after cross over.
+        L: system sizes.
+        N: number of iterations the model runs for.
+        p: probability of setting threshold gradients to 1.
+        seed: seed for the random number generators, each system size gets an 
+              independent stream spawned from it.
+        directory: directory to hold the data stores.
+        engine: 'python' or 'cpp', falling back to 'python' if the compiled
+                kernel is not available.
+        workers: number of processes to spread the system sizes over, None
+                 runs them in series.
     '''
     
-    # array of system objects for different sizes
+    engine = check_mode(engine)
+    root = np.random.SeedSequence(seed)
     start = timer()
+    jobs = [(i, (engine, l, N, p, root, directory)) for i, l in sorted(enumerate(L), key=lambda job: -job[1])]
+    times = run_jobs(acquire_system, jobs, workers)
     for i, l in enumerate(L):
-        start1 = timer()
-        system = oslo.System(l)
-        system.iterate(N)
-        end1 = timer()
-        print('Run time for L={}: {} s.'.format(l, (end1-start1)))
-        np.save('data/avalanche_data/avalanche_sizes_{}_{}'.format(l, N), system.recurrent_s())
+        print('Run time for L={}: {} s.'.format(l, times[i]))
         
     end = timer()
     print('Total run time: {} s.'.format((end-start)))
 
+def acquire_avalanche_data(L, N):
+    # avalanche sizes and heights are now always acquired together
+    acquire_data(L, N)
+
 def acquire_height_data(L, N):
-    
-    '''
-    acquire_height_data: acquires and saves system height time series for recurrent phase.
-    produces file of form: 'height_data_L.csv'.
-    Args: 
-        L: system size.
-        N: number of data points/number of iterations model runs for after cross over.
-    '''
-        
-    # array of system objects for different sizes
-    start = timer()
-    for i, l in enumerate(L):
-        start1 = timer()
-        system = oslo.System(l)
-        system.iterate(N)
-        end1 = timer()
-        print('Run time for L={}: {} s.'.format(l, (end1-start1)))
-        np.save('data/height_data/height_data_{}_{}'.format(l, N), system.recurrent_h())
-        
-    end = timer()
-    print('Total run time: {} s.'.format((end-start)))
+    # avalanche sizes and heights are now always acquired together
+    acquire_data(L, N)
 
-L = [8, 16, 32, 64, 128, 256]
-#acquire_avalanche_data(L, 10**4)
-#acquire_avalanche_data(L, 10**5)
-acquire_height_data(L, 10**5)
\ No newline at end of file
+if __name__ == "__main__":
+    
+    parser = argparse.ArgumentParser(description='Acquires recurrent Oslo model data into data stores.')
+    parser.add_argument('--L', type=int, nargs='+', default=[8, 16, 32, 64, 128, 256], help='system sizes')
+    parser.add_argument('--N', type=int, default=10**5, help='number of iterations')
+    parser.add_argument('--p', type=float, default=0.5)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--directory', default='data/oslo_store')
+    parser.add_argument('--engine', choices=['python', 'cpp'], default='python')
+    parser.add_argument('--workers', type=int, help='processes to spread the system sizes over')
+    args = parser.parse_args()
+    acquire_data(args.L, args.N, args.p, seed=args.seed, directory=args.directory,
+                 engine=args.engine, workers=args.workers)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import numpy as np
+
+def store_path(directory, L, N):
+    # directory of the data store for system size L run for N iterations
+    return os.path.join(directory, 'oslo_{}_{}'.format(L, N))
+
+class Data_Store:
+    '''
+    Data_Store: appendable on-disk store of the recurrent avalanche sizes and
+    heights of an Oslo model run. Each series is a flat binary file of a
+    compact integer type (uint32 for s, uint16 for h) which is appended to as
+    the simulation runs and read back with np.memmap, so analysis gets zero-copy
+    slices. Run parameters (L, p, seed, t_c, N) are kept in meta.json.
+    Important methods:
+        create: creates a new, empty store.
+        append: appends a chunk of recurrent heights and avalanche sizes.
+        avalanche_sizes, heights: read-only memory-mapped arrays of the data.
+    '''
+
+    dtypes = {'avalanche_sizes': np.uint32, 'heights': np.uint16}
+
+    def __init__(self, path):
+
+        '''
+        Opens an existing store.
+
+        Args:
+            path: directory of the store.
+        '''
+
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.metadata = json.load(f)
+
+    @classmethod
+    def create(cls, path, **metadata):
+        '''
+        create: creates a new, empty store, replacing any store at path.
+        Args:
+            path: directory of the store.
+            metadata: run parameters to record, e.g. L, p, seed, N.
+        Returns:
+            store: the new Data_Store.
+        '''
+
+        os.makedirs(path, exist_ok=True)
+        for name in cls.dtypes:
+            open(os.path.join(path, name + '.bin'), 'wb').close()
+        metadata['n'] = 0 # number of samples stored
+        metadata['dtypes'] = {name: np.dtype(dtype).name for name, dtype in cls.dtypes.items()}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(metadata, f)
+        return cls(path)
+
+    def __len__(self):
+        return self.metadata['n']
+
+    def file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def save_metadata(self):
+        # metadata is written to a temporary file first so it is never left half written
+        temporary = os.path.join(self.path, 'meta.json.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(temporary, os.path.join(self.path, 'meta.json'))
+
+    def update_metadata(self, **metadata):
+        self.metadata.update(metadata)
+        self.save_metadata()
+
+    def append(self, heights, avalanche_sizes):
+        '''
+        append: appends a chunk of recurrent data to the store.
+        Args:
+            heights: array-like, recurrent heights.
+            avalanche_sizes: array-like, recurrent avalanche sizes.
+        '''
+
+        if len(heights) != len(avalanche_sizes):
+            raise ValueError('Heights and avalanche sizes must have the same length.')
+        for name, data in (('heights', heights), ('avalanche_sizes', avalanche_sizes)):
+            data = np.asarray(data)
+            dtype = self.dtypes[name]
+            if len(data) > 0 and (data.min() < 0 or data.max() > np.iinfo(dtype).max):
+                raise ValueError('{} do not fit in {}.'.format(name, np.dtype(dtype).name))
+            with open(self.file(name), 'ab') as f:
+                data.astype(dtype).tofile(f)
+        self.update_metadata(n=self.metadata['n'] + len(heights))
+
+    def truncate(self, n):
+        # discards everything after the first n samples, e.g. data appended
+        # after the checkpoint a run is resumed from
+        for name, dtype in self.dtypes.items():
+            with open(self.file(name), 'r+b') as f:
+                f.truncate(n * np.dtype(dtype).itemsize)
+        self.update_metadata(n=n)
+
+    def read(self, name):
+        # read-only memory map of a stored series
+        if len(self) == 0:
+            return np.zeros(0, self.dtypes[name])
+        return np.memmap(self.file(name), dtype=self.dtypes[name], mode='r', shape=(len(self),))
+
+    def avalanche_sizes(self):
+        return self.read('avalanche_sizes')
+
+    def heights(self):
+        return self.read('heights')
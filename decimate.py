@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+def linear_edges(n, bins):
+    # start index of each of (up to) bins equal width buckets of n points
+    return np.unique(np.linspace(0, n, bins + 1)[:-1].astype(np.int64))
+
+def log_edges(n, bins):
+    # start index of each of (up to) bins buckets of n points which are equally
+    # wide on a logarithmic axis, the first point being t=1
+    edges = np.geomspace(1, n + 1, bins + 1)[:-1].astype(np.int64) - 1
+    return np.unique(edges)
+
+def minmax_decimate(y, edges, x=None):
+    '''
+    minmax_decimate: reduces a series to the minimum and maximum of each bucket
+    of points, so that a line plot of the result draws the same envelope as
+    the full series when each bucket is no wider than a pixel.
+    Args:
+        y: array-like, series to decimate.
+        edges: array-like, start index of each bucket, increasing.
+        x: array-like, x values of the series, default the index of each point.
+    Returns:
+        x, y: decimated series, two points per bucket.
+    '''
+
+    y = np.asarray(y)
+    edges = np.asarray(edges)
+    if len(y) <= 2 * len(edges):
+        return (np.arange(len(y)) if x is None else np.asarray(x)), y
+    x_start = edges if x is None else np.asarray(x)[edges]
+    y_min = np.minimum.reduceat(y, edges)
+    y_max = np.maximum.reduceat(y, edges)
+    return np.repeat(x_start, 2), np.column_stack((y_min, y_max)).ravel()
+
+def pixel_width(ax):
+    # width of the axes in pixels
+    return max(int(ax.get_window_extent().width), 1)
+
+def plot_series(ax, y, x=None, log=False, xlim=None, **kwargs):
+    '''
+    plot_series: plots a long time series decimated to the width of the axes.
+    Args:
+        ax: matplotlib axes to plot on.
+        y: array-like, series to plot.
+        x: array-like, increasing x values, default the index of each point.
+        log: bool, use buckets of equal width on a logarithmic x axis, for
+             log-log plots.
+        xlim: (lower, upper) x range shown, only points in this range are used
+              so zoomed plots keep their resolution.
+        kwargs: passed on to ax.plot.
+    Returns:
+        lines: the lines added by ax.plot.
+    '''
+
+    y = np.asarray(y)
+    first = 0
+    if xlim is not None:
+        x_values = np.arange(len(y)) if x is None else np.asarray(x)
+        first, last = np.searchsorted(x_values, xlim[0]), np.searchsorted(x_values, xlim[1], 'right')
+        first, last = max(first - 1, 0), min(last + 1, len(y))
+        y = y[first:last]
+        x = x_values[first:last]
+    bins = 2 * pixel_width(ax) # two buckets per pixel
+    edges = log_edges(len(y), bins) if log else linear_edges(len(y), bins)
+    x_plot, y_plot = minmax_decimate(y, edges, x)
+    if x is None:
+        x_plot = x_plot + first
+    lines = ax.plot(x_plot, y_plot, **kwargs)
+    if xlim is not None:
+        ax.set_xlim(*xlim)
+    return lines
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import argparse
+import numpy as np
+from scipy import stats
+import oslo_kernel
+from oslo_batch import Batch_System
+from run_oslo import seed_sequence, job_seed_sequence, batch_stream
+from benchmark import new_system
+
+engines = ('python', 'python_sweep', 'cpp', 'batch') # engines which can be compared
+
+def run_engine(engine, L, N, p=0.5, seed=None, M=10):
+    '''
+    run_engine: runs M independent replicas of one system size with an engine.
+    Args:
+        engine: 'python', 'python_sweep', 'cpp' or 'batch'.
+        L: system size.
+        N: number of iterations of each replica, which must exceed t_c.
+        p: probability of a threshold gradient of 1.
+        seed: seed of the replicas, each replica gets an independent stream
+              spawned from it as in run_oslo_multi.
+        M: number of replicas.
+    Returns:
+        replicas: list of (recurrent_h, recurrent_s, t_c) of each replica.
+    '''
+
+    root = seed_sequence(seed)
+    if engine == 'batch':
+        system = Batch_System(L, M, p, seed=job_seed_sequence(root, batch_stream, L))
+        system.iterate(N)
+        replicas = [(system.recurrent_h(m), system.recurrent_s(m), system.t_c[m]) for m in range(M)]
+    else:
+        replicas = []
+        for m in range(M):
+            system = new_system(engine, L, p, job_seed_sequence(root, m, L))
+            system.iterate(N)
+            replicas.append((system.recurrent_h(), system.recurrent_s(), system.t_c))
+    if any(t_c is None for h, s, t_c in replicas):
+        raise ValueError('N={} is too small for L={} to reach the recurrent phase.'.format(N, L))
+    return replicas
+
+def reproducible_N(L, N):
+    # iterations of the reproducibility check, enough to pass the transient
+    # (t_c ~ 0.87 L**2) and take some recurrent samples without running all N
+    return min(N, L**2 + 1000)
+
+def reproducible(engine, L, N, p=0.5, seed=0):
+    # whether two runs of an engine with the same seed give identical output
+    first, second = (run_engine(engine, L, N, p, seed, M=2) for run in range(2))
+    return all(np.array_equal(h_1, h_2) and np.array_equal(s_1, s_2) and t_c_1 == t_c_2
+               for (h_1, s_1, t_c_1), (h_2, s_2, t_c_2) in zip(first, second))
+
+def replica_statistics(replicas, thin):
+    # pooled, thinned recurrent samples and the per replica <h>, sigma_h and t_c
+    h = np.concatenate([h[::thin] for h, s, t_c in replicas])
+    s = np.concatenate([s[::thin] for h, s, t_c in replicas])
+    mean_h = np.array([np.mean(h) for h, s, t_c in replicas])
+    sd_h = np.array([np.std(h) for h, s, t_c in replicas])
+    t_c = np.array([t_c for h, s, t_c in replicas], np.float64)
+    return h, s, {'mean_h': mean_h, 'sd_h': sd_h, 't_c': t_c}
+
+def z_score(x, y):
+    # difference of the means of two sets of independent replicas in units
+    # of its standard error
+    error = np.sqrt(np.var(x, ddof=1) / len(x) + np.var(y, ddof=1) / len(y))
+    difference = np.mean(x) - np.mean(y)
+    if error == 0:
+        return 0. if difference == 0 else np.inf
+    return difference / error
+
+def compare(replicas, reference, thin=1, alpha=1e-3, z_max=4.):
+    '''
+    compare: tests whether the replicas of an engine and of a reference engine
+    are statistically equivalent. Two sample KS tests compare the pooled
+    recurrent avalanche sizes and heights, which are thinned to every thin-th
+    sample since the KS test assumes independent samples. <h>, sigma_h and t_c
+    are compared as the means over the independent replicas.
+    Args:
+        replicas, reference: output of run_engine for the engine and the reference.
+        thin: int, stride of the samples used in the KS tests.
+        alpha: KS p-value below which the distributions differ.
+        z_max: difference of the means, in standard errors, above which an
+               observable differs.
+    Returns:
+        result: dict of the KS p-values of s and h, the z-scores of <h>,
+                sigma_h and t_c, and whether every test passed.
+    '''
+
+    h, s, observables = replica_statistics(replicas, thin)
+    h_ref, s_ref, observables_ref = replica_statistics(reference, thin)
+    result = {'ks_p_s': float(stats.ks_2samp(s, s_ref).pvalue), 'ks_p_h': float(stats.ks_2samp(h, h_ref).pvalue)}
+    for name in observables:
+        result['z_' + name] = float(z_score(observables[name], observables_ref[name]))
+    result['passed'] = bool(min(result['ks_p_s'], result['ks_p_h']) >= alpha and
+                            all(abs(result['z_' + name]) <= z_max for name in observables))
+    return result
+
+def check_engines(engines=engines, L=[8, 16, 32], N=10000, p=0.5, seed=0, M=10, reference='cpp',
+                  thin=None, alpha=1e-3, z_max=4.):
+    '''
+    check_engines: checks that every engine is reproducible with a fixed seed
+    and statistically equivalent to the reference engine for each system size.
+    Args:
+        engines: engines to check, the compiled kernel is skipped if unavailable.
+        L: array-like, system sizes.
+        N: number of iterations of each replica.
+        p: probability of a threshold gradient of 1.
+        seed: seed of the replicas, the reference uses an independent stream.
+        M: number of replicas of each engine and system size.
+        reference: engine the others are compared with, 'python' if 'cpp' is
+                   unavailable.
+        thin: stride of the samples in the KS tests, default L.
+        alpha, z_max: see compare.
+    Returns:
+        results: list of dicts of the engine, L, reproducibility and the
+                 output of compare.
+    '''
+
+    if not oslo_kernel.available():
+        engines = [engine for engine in engines if engine != 'cpp']
+        if reference == 'cpp':
+            reference = 'python'
+    root = seed_sequence(seed)
+    results = []
+    for l in L:
+        # the reference replicas are independent of those of the engines
+        reference_replicas = run_engine(reference, l, N, p, root.spawn(1)[0], M)
+        for engine in engines:
+            result = {'engine': engine, 'L': l,
+                      'reproducible': reproducible(engine, l, reproducible_N(l, N), p, seed)}
+            if engine != reference:
+                result.update(compare(run_engine(engine, l, N, p, root, M), reference_replicas,
+                                      thin or l, alpha, z_max))
+            else:
+                result['passed'] = True
+            result['passed'] = result['passed'] and result['reproducible']
+            print('{} L={}: {}'.format(engine, l, ', '.join('{}={:.3g}'.format(key, value)
+                  if isinstance(value, float) else '{}={}'.format(key, value)
+                  for key, value in result.items() if key not in ('engine', 'L'))))
+            results.append(result)
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Checks that the Oslo model engines are statistically equivalent.')
+    parser.add_argument('--engines', nargs='+', choices=engines, default=list(engines))
+    parser.add_argument('--L', type=int, nargs='+', default=[8, 16, 32], help='system sizes')
+    parser.add_argument('--N', type=int, default=10000, help='iterations of each replica')
+    parser.add_argument('--M', type=int, default=10, help='replicas of each engine and system size')
+    parser.add_argument('--p', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reference', choices=engines, default='cpp')
+    parser.add_argument('--thin', type=int, help='stride of the samples in the KS tests, default L')
+    parser.add_argument('--alpha', type=float, default=1e-3, help='KS p-value threshold')
+    parser.add_argument('--z-max', type=float, default=4., help='tolerance in standard errors')
+    args = parser.parse_args()
+
+    results = check_engines(args.engines, args.L, args.N, args.p, args.seed, args.M, args.reference,
+                            args.thin, args.alpha, args.z_max)
+    failed = [result for result in results if not result['passed']]
+    if failed:
+        print('Not equivalent: {}'.format(', '.join('{} L={}'.format(result['engine'], result['L'])
+                                                   for result in failed)))
+        raise SystemExit(1)
+    print('All engines equivalent.')
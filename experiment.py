@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+from timeit import default_timer as timer
+import numpy as np
+import matplotlib.pyplot as plt
+from crossover_analysis import Crossover_Analysis, Crossover_Analysis_Multi
+from avalanche_probability_analysis import Avalanche_Probability_Analysis, Avalanche_Probability_Analysis_Multi
+from height_analysis import Height_Analysis, Height_Analysis_Multi
+from run_oslo import run_oslo, run_oslo_multi
+from data_acquisition import acquire_data
+from result_cache import Result_Cache
+from helper import latexfigure, headless, export_figures
+
+# stages in the order they are run
+stages = ('acquire', 'crossover', 'crossover_multi', 'avalanche', 'avalanche_multi',
+          'height', 'height_multi')
+
+defaults = {
+    'name': 'experiment', # results are written to <output>/<name>
+    'L': [8, 16, 32, 64, 128, 256], # system sizes
+    'N': 10**5, # iterations, or recurrent samples if recurrent_only
+    'M': 5, # runs for the multi stages
+    'p': 0.5, # probability of a threshold gradient of 1
+    'engine': 'cpp', # 'cpp' or 'python', multi stages also accept the reference engine 'batch'
+    'seed': 2018, # None draws fresh entropy, recorded in the manifest
+    'workers': None, # processes for simulations and figure rendering
+    'threads': None, # threads of the compiled kernel, used instead of workers for 'cpp'
+    'stream': False, # keep only running statistics of the recurrent phase
+    'recurrent_only': False, # take N samples after t_c, not storing the transient
+    'cache': 'data/cache', # result cache directory, None disables it
+    'store': 'data/oslo_store', # data store directory for the acquire stage
+    'output': 'results', # directory for figures, logs and the manifest
+    'format': 'pdf', # figure file format
+    'latex': None, # figure scale for LaTeX typesetting, None for plain text
+    't_s': 1.55, # avalanche exponent used for the data collapse
+    'D': 2.25, # avalanche dimension used for the data collapse
+    'scale': 1.2, # log binning scale
+    'stages': list(stages[1:]), # stages to run, acquire only writes data stores for later runs
+}
+
+# spec entries which do not change the results of a stage
+run_options = ('name', 'workers', 'threads', 'cache', 'output', 'format', 'stages')
+
+def load_spec(path=None, **overrides):
+    '''
+    load_spec: experiment spec from a JSON file, with unspecified entries
+    taken from the defaults.
+    Args:
+        path: JSON file holding a dict of spec entries, None uses the defaults.
+        overrides: entries replacing those in the file, None values are ignored.
+    Returns:
+        spec: dict of every spec entry.
+    '''
+
+    spec = dict(defaults)
+    if path is not None:
+        with open(path) as f:
+            spec.update(json.load(f))
+    spec.update({key: value for key, value in overrides.items() if value is not None})
+    unknown = set(spec) - set(defaults)
+    if unknown:
+        raise ValueError('Unknown spec entries: {}'.format(', '.join(sorted(unknown))))
+    for stage in spec['stages']:
+        if stage not in stages:
+            raise ValueError('Unknown stage: {}'.format(stage))
+    return spec
+
+def spec_hash(spec):
+    # hash of the spec entries which determine the results
+    params = {key: value for key, value in spec.items() if key not in run_options}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+class Tee(io.TextIOBase):
+    # writes to several streams, used to keep the printed output of a stage
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+
+class Experiment:
+    '''
+    Experiment: runs the stages of an experiment spec, simulating only what
+    the requested stages need. Simulations go through the result cache, so
+    they are reused by later runs and other stages with the same parameters.
+    Each stage writes its figures and printed output to the output directory
+    and records its timing and spec hash in manifest.json. Stages whose outputs
+    are already there for the same spec are skipped and their output reprinted.
+    Important methods:
+        run: runs the requested stages.
+    '''
+
+    def __init__(self, spec, force=False, show=False):
+
+        '''
+        Args:
+            spec: experiment spec, see load_spec.
+            force: rerun stages even if their outputs are up to date.
+            show: leave the figures open to be shown rather than exporting them.
+        '''
+
+        if spec['seed'] is None:
+            # fresh entropy, recorded in the manifest so that the run can be repeated
+            spec = dict(spec, seed=np.random.SeedSequence().entropy)
+        self.spec = spec
+        self.force = force
+        self.show = show
+        self.directory = os.path.join(spec['output'], spec['name'])
+        self.hash = spec_hash(spec)
+        self.cache = None if spec['cache'] is None else Result_Cache(spec['cache'])
+        self.results = {} # simulations carried out for this run, by kind
+        self.timings = {}
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self.manifest_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temporary, self.manifest_path)
+
+    def up_to_date(self, stage):
+        # whether the outputs of a stage were produced with the same spec
+        entry = self.manifest.get(stage)
+        if self.force or self.show or entry is None or entry['hash'] != self.hash:
+            return False
+        files = entry['figures'] + [entry['log']]
+        return all(os.path.exists(os.path.join(self.directory, name)) for name in files)
+
+    def single(self, recurrent_only, stream=None):
+        # run_oslo output for the spec, simulated once per run, stream
+        # overriding the spec's stream entry if given
+        spec = self.spec
+        stream = spec['stream'] if stream is None else stream
+        key = ('single', recurrent_only) + (('stream',) if stream else ())
+        if key not in self.results:
+            engine = 'python' if spec['engine'] == 'batch' else spec['engine']
+            start = timer()
+            self.results[key] = run_oslo(engine, spec['N'], spec['L'], spec['p'], seed=spec['seed'],
+                                         workers=spec['workers'], stream=stream,
+                                         cache=self.cache, recurrent_only=recurrent_only,
+                                         threads=spec['threads'])
+            self.timings['simulate ' + ' '.join(map(str, key))] = timer() - start
+        return self.results[key]
+
+    def multi(self, recurrent_only):
+        # run_oslo_multi output for the spec, simulated once per run
+        key = ('multi', recurrent_only)
+        if key not in self.results:
+            spec = self.spec
+            start = timer()
+            self.results[key] = run_oslo_multi(spec['engine'], spec['M'], spec['N'], spec['L'],
+                                               spec['p'], seed=spec['seed'], workers=spec['workers'],
+                                               stream=spec['stream'], cache=self.cache,
+                                               recurrent_only=recurrent_only, threads=spec['threads'])
+            self.timings['simulate ' + ' '.join(map(str, key))] = timer() - start
+        return self.results[key]
+
+    def stage_acquire(self):
+        spec = self.spec
+        engine = 'python' if spec['engine'] == 'batch' else spec['engine']
+        acquire_data(spec['L'], spec['N'], spec['p'], seed=spec['seed'], directory=spec['store'],
+                     engine=engine, workers=spec['workers'])
+
+    def stage_crossover(self):
+        # the transient is needed, so the full series is always stored, even
+        # if the spec streams the other stages
+        heights_data, recurrent_h_data, recurrent_s_data, t_c_data, t_c_th_data = self.single(False, stream=False)
+        c = Crossover_Analysis(L=self.spec['L'], N=self.spec['N'], h_data=heights_data,
+                               t_c_data=t_c_data, t_c_th_data=t_c_th_data)
+        c.plot_heights()
+        c.plot_t_c()
+
+    def stage_crossover_multi(self):
+        height_mean_multi, height_sd_multi, t_c_multi, t_c_th_multi, s_data_multi = self.multi(False)
+        Crossover_Analysis_Multi(self.spec['L'], t_c_multi, t_c_th_multi).plot_t_c_multi()
+
+    def stage_avalanche(self):
+        spec = self.spec
+        heights_data, recurrent_h_data, recurrent_s_data, t_c_data, t_c_th_data = self.single(spec['recurrent_only'])
+        a = Avalanche_Probability_Analysis(L=spec['L'], N=spec['N'], t_s=spec['t_s'], D=spec['D'],
+                                           a=spec['scale'], recurrent_s_data=recurrent_s_data)
+        a.plot_log_binned_pdf()
+        a.plot_pdf()
+        a.plot_moments()
+
+    def stage_avalanche_multi(self):
+        height_mean_multi, height_sd_multi, t_c_multi, t_c_th_multi, s_data_multi = self.multi(self.spec['recurrent_only'])
+        Avalanche_Probability_Analysis_Multi(self.spec['L'], s_data_multi).exponents_multi()
+
+    def stage_height(self):
+        spec = self.spec
+        heights_data, recurrent_h_data, recurrent_s_data, t_c_data, t_c_th_data = self.single(spec['recurrent_only'])
+        h = Height_Analysis(L=spec['L'], N=spec['N'], recurrent_h_data=recurrent_h_data)
+        h.plot_sd()
+        h.plot_scaling_correction()
+        h.plot_height_probability()
+
+    def stage_height_multi(self):
+        height_mean_multi, height_sd_multi, t_c_multi, t_c_th_multi, s_data_multi = self.multi(self.spec['recurrent_only'])
+        h_m = Height_Analysis_Multi(self.spec['L'], height_mean_multi, height_sd_multi)
+        h_m.plot_mean_multi()
+        h_m.plot_sd_multi()
+        h_m.plot_scaling_correction_multi()
+
+    def run_stage(self, stage):
+        # runs one stage, keeping its printed output and figures
+        log = stage + '.log'
+        if self.up_to_date(stage):
+            print('Stage {}: up to date, reusing outputs from {}.'.format(stage, self.directory))
+            with open(os.path.join(self.directory, log)) as f:
+                sys.stdout.write(f.read())
+            return
+
+        print('Stage {}:'.format(stage))
+        os.makedirs(self.directory, exist_ok=True)
+        start = timer()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(Tee(sys.stdout, output)):
+            getattr(self, 'stage_' + stage)()
+        figures = []
+        if not self.show:
+            for fig in map(plt.figure, plt.get_fignums()):
+                fig.tight_layout()
+            paths = export_figures(self.directory, self.spec['format'], self.spec['workers'], prefix=stage)
+            figures = [os.path.basename(path) for path in paths]
+        with open(os.path.join(self.directory, log), 'w') as f:
+            f.write(output.getvalue())
+        self.timings[stage] = timer() - start
+
+        self.manifest[stage] = {'hash': self.hash, 'spec': self.spec, 'figures': figures,
+                                'log': log, 'time': self.timings[stage]}
+        self.save_manifest()
+
+    def run(self):
+        '''
+        run: runs the stages of the spec in order.
+        Returns:
+            timings: dict of the time taken by each stage and simulation in seconds.
+        '''
+
+        if self.spec['latex'] is not None:
+            latexfigure(self.spec['latex'])
+        for stage in stages:
+            if stage in self.spec['stages']:
+                self.run_stage(stage)
+        print('Timings for {}:'.format(self.spec['name']))
+        for name, time in self.timings.items():
+            print('    {}: {:.2f} s'.format(name, time))
+        return self.timings
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Runs an Oslo model experiment from a spec.')
+    parser.add_argument('spec', nargs='?', help='JSON file of spec entries, see experiment.defaults')
+    parser.add_argument('--name', help='experiment name, results go to OUTPUT/NAME')
+    parser.add_argument('--L', type=int, nargs='+', help='system sizes')
+    parser.add_argument('--N', type=int, help='iterations, or recurrent samples with --recurrent-only')
+    parser.add_argument('--M', type=int, help='runs for the multi stages')
+    parser.add_argument('--p', type=float, help='probability of a threshold gradient of 1')
+    parser.add_argument('--engine', choices=['cpp', 'python', 'batch'])
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--workers', type=int, help='processes for simulations and figures')
+    parser.add_argument('--threads', type=int, help='threads of the compiled kernel')
+    parser.add_argument('--stream', action='store_const', const=True)
+    parser.add_argument('--recurrent-only', action='store_const', const=True, dest='recurrent_only')
+    parser.add_argument('--cache', help='result cache directory')
+    parser.add_argument('--store', help='data store directory for the acquire stage')
+    parser.add_argument('--output', help='output directory')
+    parser.add_argument('--format', help='figure file format')
+    parser.add_argument('--latex', type=float, help='figure scale for LaTeX typesetting')
+    parser.add_argument('--stages', nargs='+', choices=stages)
+    parser.add_argument('--force', action='store_true', help='rerun up to date stages')
+    parser.add_argument('--show', action='store_true', help='show the figures instead of exporting them')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = vars(parse_args(argv))
+    path, force, show = args.pop('spec'), args.pop('force'), args.pop('show')
+    spec = load_spec(path, **args)
+    if not show:
+        headless()
+    Experiment(spec, force=force, show=show).run()
+    if show:
+        plt.show()
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,82 @@
 # -*- coding: utf-8 -*-
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy import stats
+from scipy import stats, optimize
+from running_statistics import Running_Statistics
 #from run_oslo import Run
 
+def correction_r_values(L, mean_h, a_0):
+    '''
+    correction_r_values: linear regressions of log(1 - <h>/a_0L) against log(L)
+    for every value of a_0 and every run at once, by broadcasting the least
+    squares sums.
+    Args:
+        L: array-like, system sizes.
+        mean_h: array-like, average heights indexed [..., i] for system size L[i].
+        a_0: array-like, a_0 values to test.
+    Returns:
+        r_value, slope, intercept: regression results indexed [..., j] for a_0[j].
+        log_mean_h: log(1 - <h>/a_0L) indexed [..., j, i].
+    '''
+    L = np.asarray(L, np.float64)
+    log_L = np.log(L)
+    mean_h = np.asarray(mean_h, np.float64)[..., np.newaxis, :]
+    a_0 = np.asarray(a_0, np.float64)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_mean_h = np.log(1. - mean_h / (a_0 * L))
+    x = log_L - np.mean(log_L)
+    y = log_mean_h - np.mean(log_mean_h, axis=-1, keepdims=True)
+    sxx = np.sum(x**2)
+    sxy = np.sum(x * y, axis=-1)
+    syy = np.sum(y**2, axis=-1)
+    slope = sxy / sxx
+    intercept = np.mean(log_mean_h, axis=-1) - slope * np.mean(log_L)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r_value = sxy / np.sqrt(sxx * syy)
+    return r_value, slope, intercept, log_mean_h
+
+def fit_scaling_correction(L, mean_h, a_0=None, refine=False):
+    '''
+    fit_scaling_correction: finds the a_0 giving the most linear (lowest negative
+    R value) relationship between log(1 - <h>/a_0L) and log(L), for one run or
+    for every run at once.
+    Args:
+        L: array-like, system sizes.
+        mean_h: array-like, average heights indexed [i] for system size L[i], or
+                [m, i] for run m.
+        a_0: array-like, grid of a_0 values to test, default 100 values in
+             [1.73, 1.75].
+        refine: bool, refines the best grid value of each run with a bounded
+                1-D minimisation of the R value between its neighbours.
+    Returns:
+        min_r, min_a_0, min_slope, min_intercept, min_log_mean_h_data, omega_1:
+        results at the best a_0, with a leading run axis if mean_h has one.
+    '''
+    if a_0 is None:
+        a_0 = np.linspace(1.73, 1.75, 100)
+    a_0 = np.asarray(a_0, np.float64)
+    mean_h = np.asarray(mean_h, np.float64)
+    runs = mean_h.reshape(-1, mean_h.shape[-1])
+    r_value, slope, intercept, log_mean_h = correction_r_values(L, runs, a_0)
+    # invalid a_0 (a_0 L below <h>) give nan and are never chosen
+    best = np.nanargmin(np.where(np.isnan(r_value), np.inf, r_value), axis=1)
+    min_a_0 = a_0[best]
+    
+    if refine and len(a_0) > 1:
+        for m, j in enumerate(best):
+            bounds = (a_0[max(j - 1, 0)], a_0[min(j + 1, len(a_0) - 1)])
+            r = lambda a: correction_r_values(L, runs[m], [a])[0][0]
+            min_a_0[m] = optimize.minimize_scalar(r, bounds=bounds, method='bounded').x
+        r_value, slope, intercept, log_mean_h = correction_r_values(L, runs, min_a_0)
+        index = (np.arange(len(runs)), np.arange(len(runs)))
+    else:
+        index = (np.arange(len(runs)), best)
+    
+    results = (r_value[index], min_a_0, slope[index], intercept[index], log_mean_h[index], -slope[index])
+    if mean_h.ndim == 1:
+        return tuple(result[0] for result in results)
+    return results
+
 class Height_Analysis:
     '''
     Height_Analysis: class for carrying out analysis of the height/height probability
@@ -16,6 +89,8 @@ class Height_Analysis:
                                  to average system height, estimating omega_1, a_0.
         plot_height_probabiity: plots the system height probability distribution
                                 for specified values of L and performs a data collapse.
+    recurrent_h_data may hold the recurrent height arrays or the 
+    Running_Statistics accumulators of a streamed run for each system size.
     '''    
     
     def __init__(self, L, N, recurrent_h_data):
@@ -34,10 +109,23 @@ class Height_Analysis:
             self.mean_h_data.append(self.mean(self.recurrent_h_data[i]))
         
         for i, l in enumerate(self.L):
-            self.sd_h_data.append(np.std(self.recurrent_h_data[i]))
+            self.sd_h_data.append(self.std(self.recurrent_h_data[i]))
     
     def mean(self, height_data):
-        return sum(height_data) / len(height_data)
+        if isinstance(height_data, Running_Statistics):
+            return height_data.mean_h()
+        return np.mean(height_data) # accumulates in float64, heights may be int32
+    
+    def std(self, height_data):
+        if isinstance(height_data, Running_Statistics):
+            return height_data.sd_h()
+        return np.std(height_data)
+    
+    def distribution(self, height_data):
+        # observed heights and their frequencies
+        if isinstance(height_data, Running_Statistics):
+            return height_data.h_distribution()
+        return np.unique(height_data, return_counts=True)
         
     def sd(self, L, data):
         
@@ -77,45 +165,21 @@ class Height_Analysis:
         ax3.set_xlabel(r'$\log(L)$')
         ax3.set_ylabel(r'$\log(\sigma_h)$')
 
-    def scaling_correction(self, data):
+    def scaling_correction(self, data, a_0=None, refine=False):
         
         # determines the parameter values for corrections to scaling by analysing
         # which parameter values produce the most linear relationship
-        # returns the parameter values found
-        
-        # range of a_0 values to test for good fit 
-        a_0 = np.linspace(1.73, 1.75, 100) 
-        log_mean_h_data = [] # log_mean_h is in fact the log{(1-\langle{h}\rangle/a_0L)} quantity in the report.
-        slope_data = []
-        intercept_data = []
-        r_value_data = []
-        
-        for a in a_0:
-            log_mean_h = [np.log(1. - h / (a * self.L[i])) for i, h in enumerate(data)]
-            linregsoln = stats.linregress(self.log_L, log_mean_h)
-            # carry out a linear regression for each value of a0 to find the best value from the R value
-            slope, intercept, r_value, p_value, std_err = linregsoln
-            slope_data.append(slope)
-            intercept_data.append(intercept)
-            r_value_data.append(r_value)
-            log_mean_h_data.append(log_mean_h)
-        
+        # returns the parameter values found (see fit_scaling_correction).
+        # a_0 is the grid of values to test, default 100 values in [1.73, 1.75],
+        # and refine improves the best grid value with a 1-D minimisation.
         # as negative linear relationship, best value is found from lowest negative R value
-        min_r, min_r_index = min([(r, i) for i, r in enumerate(r_value_data)])
-        min_a_0 = a_0[min_r_index]
-        min_slope = slope_data[min_r_index]
-        min_intercept = intercept_data[min_r_index]
-        min_log_mean_h_data = log_mean_h_data[min_r_index]
-        omega_1 = -slope_data[min_r_index]
-        
-            
-        return min_r, min_a_0, min_slope, min_intercept, min_log_mean_h_data, omega_1
+        return fit_scaling_correction(self.L, data, a_0, refine)
     
-    def plot_scaling_correction(self):
+    def plot_scaling_correction(self, a_0=None, refine=False):
         
         # plots the results from the fit to corrections to scaling ansatz
         
-        min_r, min_a_0, min_slope, min_intercept, min_log_mean_h_data, omega_1 = self.scaling_correction(self.mean_h_data)
+        min_r, min_a_0, min_slope, min_intercept, min_log_mean_h_data, omega_1 = self.scaling_correction(self.mean_h_data, a_0, refine)
         
         print('Best fitting a_0: {} with R-Val: {}'.format(min_a_0, min_r))
         print('Implies omega_1: {}'.format(omega_1))
@@ -136,7 +200,7 @@ class Height_Analysis:
         freq_data = []
         # populates the probability distribution arrays
         for i, l in enumerate(self.L):
-            val, freq = np.unique(self.recurrent_h_data[i], return_counts=True)
+            val, freq = self.distribution(self.recurrent_h_data[i])
             val_data.append(val)
             freq_data.append(freq)
         
@@ -231,50 +295,17 @@ class Height_Analysis_Multi:
         ax1.set_xlabel(r'$\log(L)$')
         ax1.set_ylabel(r'$\log(\langle{\sigma(L)}\rangle)$')
         
-    def scaling_correction(self, data):
+    def scaling_correction(self, data, a_0=None, refine=False):
         
-        a_0 = np.linspace(1.73, 1.75, 100)
-        log_mean_h_data = []
-        slope_data = []
-        intercept_data = []
-        r_value_data = []
-        
-        for a in a_0:
-            log_mean_h = [np.log(1. - h / (a * self.L[i])) for i, h in enumerate(data)]
-            linregsoln = stats.linregress(self.log_L, log_mean_h)
-            slope, intercept, r_value, p_value, std_err = linregsoln
-            slope_data.append(slope)
-            intercept_data.append(intercept)
-            r_value_data.append(r_value)
-            log_mean_h_data.append(log_mean_h)
-            
-        min_r, min_r_index = min([(r, i) for i, r in enumerate(r_value_data)])
-        min_a_0 = a_0[min_r_index]
-        min_slope = slope_data[min_r_index]
-        min_intercept = intercept_data[min_r_index]
-        min_log_mean_h_data = log_mean_h_data[min_r_index]
-        omega_1 = -slope_data[min_r_index]
-        
-            
-        return min_r, min_a_0, min_slope, min_intercept, min_log_mean_h_data, omega_1
+        # corrections to scaling fit for one run, or for every run at once if
+        # data is indexed [m, i] (see fit_scaling_correction)
+        return fit_scaling_correction(self.L, data, a_0, refine)
     
-    def plot_scaling_correction_multi(self):
-        
-        a_0_multi = []
-        omega_1_multi = []
-        min_slope_multi = []
-        min_intercept_multi = []
-        min_r_multi = []
-        min_log_mean_h_data_multi = []
-        
-        for h in self.h_mean_m:
-            min_r, min_a_0, min_slope, min_intercept, min_log_mean_h_data, omega_1 = self.scaling_correction(h)
-            a_0_multi.append(min_a_0)
-            omega_1_multi.append(omega_1)
-            min_slope_multi.append(min_slope)
-            min_intercept_multi.append(min_intercept)
-            min_r_multi.append(min_r)
-            min_log_mean_h_data_multi.append(min_log_mean_h_data)
+    def plot_scaling_correction_multi(self, a_0=None, refine=False):
+        
+        # fits every run in a single broadcasted computation
+        min_r_multi, a_0_multi, min_slope_multi, min_intercept_multi, min_log_mean_h_data_multi, omega_1_multi = \
+            self.scaling_correction(self.h_mean_m, a_0, refine)
         
         a_0_mean = np.mean(a_0_multi)
         a_0_sd = np.std(a_0_multi)
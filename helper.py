@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
+import pickle
 import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import rc
 from pylab import rcParams
 
@@ -30,4 +35,57 @@ def latexfigure(scale):
     
     rc('font', **{'family':'sans-serif','sans-serif':['Computer Modern Sans serif'], 'size':9}) #
     rc('text', usetex=True)
-    rcParams['figure.figsize'] = figsize(scale)[0], figsize(scale)[1]
\ No newline at end of file
+    rcParams['figure.figsize'] = figsize(scale)[0], figsize(scale)[1]
+
+def headless():
+    '''
+    headless: switches matplotlib to the non-interactive Agg backend, so
+    figures can be produced without a display. Should be called before any
+    figures are created.
+    '''
+    
+    matplotlib.use('Agg')
+
+def init_render_worker(params):
+    # each render worker uses the Agg backend and the parent's rc parameters
+    matplotlib.use('Agg')
+    rcParams.update(params)
+
+def save_figure(figure, path, dpi=None):
+    # renders a pickled figure to a file in a worker process
+    pickle.loads(figure).savefig(path, dpi=dpi)
+    return path
+
+def export_figures(directory, format='pdf', workers=None, dpi=None, prefix='figure'):
+    '''
+    export_figures: writes every open figure to a file and closes it. With
+    workers the figures are pickled and rendered in parallel processes, which
+    matters most with LaTeX text rendering. matplotlib caches LaTeX renderings
+    in its cache directory (~/.cache/matplotlib, or MPLCONFIGDIR if set), so
+    they are reused between runs.
+    Args: 
+        directory: directory to write the figures to.
+        format: file format, e.g. 'pdf' or 'png'.
+        workers: number of processes to render in, None or 1 renders in series.
+        dpi: resolution for raster formats, default from rcParams.
+        prefix: figure n is written to <prefix>_<n>.<format>.
+    Returns: 
+        paths: file names of the written figures.
+    '''
+    
+    os.makedirs(directory, exist_ok=True)
+    numbers = plt.get_fignums()
+    paths = [os.path.join(directory, '{}_{}.{}'.format(prefix, n, format)) for n in numbers]
+    if workers is None or workers <= 1:
+        for n, path in zip(numbers, paths):
+            plt.figure(n).savefig(path, dpi=dpi)
+    else:
+        params = {key: value for key, value in rcParams.items() if key != 'backend'}
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker, 
+                                 initargs=(params,)) as executor:
+            figures = [pickle.dumps(plt.figure(n)) for n in numbers]
+            for future in [executor.submit(save_figure, figure, path, dpi) 
+                           for figure, path in zip(figures, paths)]:
+                future.result()
+    plt.close('all')
+    return paths
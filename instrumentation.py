@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# counters, in the order of the Counter enum of oslo.cpp
+counter_names = ('grains', 'topples', 'sweeps', 'empty_sweeps', 'site_checks', 'rng_draws', 'rng_calls')
+GRAINS, TOPPLES, SWEEPS, EMPTY_SWEEPS, SITE_CHECKS, RNG_DRAWS, RNG_CALLS = range(len(counter_names))
+# timed phases, in the order of the Phase enum of oslo.cpp
+phase_names = ('drive', 'relax', 'record', 'rng')
+DRIVE, RELAX, RECORD, RNG = range(len(phase_names))
+
+class Counters:
+    '''
+    Counters: hot path counters and phase times of an instrumented run, shared
+    by oslo.System(instrument=True) and oslo_kernel.Kernel_System(instrument=True).
+    The counts are held in an int64 array and the times in seconds in a float64
+    array, which the compiled kernel adds to directly. Counted are:
+        grains: avalanches relaxed, i.e. iterations.
+        topples: sites toppled.
+        sweeps: passes over every site by the sweep engines, 0 for the stack engine.
+        empty_sweeps: sweeps which found no unstable site.
+        site_checks: comparisons of a slope with its threshold.
+        rng_draws: threshold gradients drawn.
+        rng_calls: calls to the random number generator, one per block of
+                   thresholds for the python model.
+    The phases are drive, relax and record (storing heights and avalanche
+    sizes, running statistics and data stores), with rng the part of the
+    relaxation time spent drawing thresholds.
+    Important methods:
+        summary: counts, times and derived rates as a dict.
+        report: prints the summary.
+    '''
+
+    def __init__(self):
+        self.counts = np.zeros(len(counter_names), np.int64)
+        self.times = np.zeros(len(phase_names), np.float64)
+
+    def __getitem__(self, name):
+        if name in counter_names:
+            return int(self.counts[counter_names.index(name)])
+        return float(self.times[phase_names.index(name)])
+
+    def reset(self):
+        self.counts[:] = 0
+        self.times[:] = 0
+
+    def summary(self):
+        '''
+        summary: counts, phase times and derived quantities.
+        Returns:
+            summary: dict of each counter, each phase time in seconds (<phase>_time),
+                     wasted_checks (site checks which found a stable site) and the
+                     per grain and per second rates.
+        '''
+
+        summary = {name: int(count) for name, count in zip(counter_names, self.counts)}
+        summary.update({name + '_time': float(time) for name, time in zip(phase_names, self.times)})
+        summary['wasted_checks'] = summary['site_checks'] - summary['topples']
+        grains = max(summary['grains'], 1)
+        for name in ('topples', 'sweeps', 'site_checks', 'wasted_checks', 'rng_draws'):
+            summary[name + '_per_grain'] = summary[name] / grains
+        total = self.times[[DRIVE, RELAX, RECORD]].sum()
+        if total > 0:
+            summary['grains_per_s'] = summary['grains'] / total
+            summary['topples_per_s'] = summary['topples'] / total
+        return summary
+
+    def report(self):
+        # prints the counters, per grain rates and the share of time in each phase
+        summary = self.summary()
+        print('Grains: {}, topples: {} ({:.3g} per grain)'.format(
+              summary['grains'], summary['topples'], summary['topples_per_grain']))
+        print('Sweeps: {} ({:.3g} per grain, {} empty)'.format(
+              summary['sweeps'], summary['sweeps_per_grain'], summary['empty_sweeps']))
+        print('Site checks: {} ({:.3g} per grain, {} wasted)'.format(
+              summary['site_checks'], summary['site_checks_per_grain'], summary['wasted_checks']))
+        print('RNG draws: {} in {} calls'.format(summary['rng_draws'], summary['rng_calls']))
+        total = self.times[[DRIVE, RELAX, RECORD]].sum()
+        for name in phase_names:
+            time = summary[name + '_time']
+            print('{} time: {:.4g} s ({:.1%})'.format(name.capitalize(), time, time / total if total > 0 else 0))
@@ -1,13 +1,59 @@
-#include "stdafx.h"
-#include <stdlib.h>     /* srand, rand */
+#include <stdint.h>
 #include <iostream>
-#include <time.h>
 #include <math.h>
+#include <vector>
+#include <chrono>
+#include <thread>
+#include <atomic>
+#include <algorithm>
 using namespace std;
 
-int set_thr(double p){
-	double r = (float)rand() / (float)RAND_MAX;
-	if (r < p){
+// export the kernel from a Windows dll or a Linux/macOS shared library
+#if defined(_WIN32)
+#define OSLO_EXPORT extern "C" __declspec(dllexport)
+#else
+#define OSLO_EXPORT extern "C" __attribute__((visibility("default")))
+#endif
+
+// xoshiro256** generator used to draw threshold gradients in place of rand()
+struct Threshold_Stream {
+	uint64_t s[4];
+
+	static uint64_t rotl(uint64_t x, int k){
+		return (x << k) | (x >> (64 - k));
+	}
+
+	void seed(uint64_t seed){
+		// fill the state using splitmix64 so any seed gives a good state
+		for (int i = 0; i < 4; i++){
+			seed += 0x9e3779b97f4a7c15ULL;
+			uint64_t z = seed;
+			z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+			z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+			s[i] = z ^ (z >> 31);
+		}
+	}
+
+	uint64_t next(){
+		uint64_t result = rotl(s[1] * 5, 7) * 9;
+		uint64_t t = s[1] << 17;
+		s[2] ^= s[0];
+		s[3] ^= s[1];
+		s[1] ^= s[2];
+		s[0] ^= s[3];
+		s[2] ^= t;
+		s[3] = rotl(s[3], 45);
+		return result;
+	}
+
+	double uniform(){
+		// uniform double in [0, 1) from the top 53 bits
+		return (next() >> 11) * (1.0 / 9007199254740992.0);
+	}
+};
+
+int set_thr(Threshold_Stream &rng, double p){
+	if (rng.uniform() < p){
 		return 1;
 	}
 	else{
@@ -15,46 +61,321 @@ int set_thr(double p){
 	}
 }
 
+// threshold gradients are packed one bit per site, 64 sites to a word, a set
+// bit meaning a threshold gradient of 2 and a clear bit a threshold of 1
+static inline int get_thr(const uint64_t *thresholds, int i){
+	return 1 + (int)((thresholds[i >> 6] >> (i & 63)) & 1);
+}
+
+static inline void set_bit(uint64_t *thresholds, int i, int zth){
+	uint64_t bit = (uint64_t)(zth - 1) << (i & 63);
+	thresholds[i >> 6] = (thresholds[i >> 6] & ~((uint64_t)1 << (i & 63))) | bit;
+}
+
+// the relaxation loop works on one byte per threshold, unpacked from the bits
+// at the start of each call and packed again at the end
+static void unpack_thr(int L, const uint64_t *thresholds, uint8_t *zth){
+	for (int i = 0; i < L; i++){
+		zth[i] = (uint8_t)get_thr(thresholds, i);
+	}
+}
+
+static void pack_thr(int L, const uint8_t *zth, uint64_t *thresholds){
+	for (int i = 0; i < L; i++){
+		set_bit(thresholds, i, zth[i]);
+	}
+}
+
 
-extern "C" __declspec(dllexport) void oslo(int N, int L, double p, int *t_c, double *t_c_theory, int *h, int *zth, int *heights, int *avalanche_sizes)
+OSLO_EXPORT void oslo_init(int L, double p, uint64_t *thresholds, uint64_t *rng_state)
 {
-	bool recurrent = false;
-	srand(time(NULL));
+	// sets the initial threshold gradients, drawing from the generator state
+	// passed in and writing the advanced state back
+	Threshold_Stream rng;
+	for (int i = 0; i < 4; i++){
+		rng.s[i] = rng_state[i];
+	}
 	for (int i = 0; i < L; i++){
-		zth[i] = set_thr(p);
+		set_bit(thresholds, i, set_thr(rng, p));
 	}
+	for (int i = 0; i < 4; i++){
+		rng_state[i] = rng.s[i];
+	}
+}
 
-	for (int i = 0; i < N; i++){
-		h[0] += 1; //drive phase
-		bool relax = true; //relaxation phase 
-		int s = 0;
-		while (relax == true){
-			relax = false;
-			for (int j = 0; j < L; j++){
-				int z = h[j] - h[j + 1];
-				if (z > zth[j]){
-					if (j < L - 1){
-						h[j] -= 1;
-						h[j + 1] += 1;
-					}
-					else{
-						h[j] -= 1;
-						if (recurrent == false){
-							t_c[0] = i;
-							recurrent = true;
-						}
+// counters and phase times of the instrumented entry points, in the order
+// of instrumentation.Counters
+enum Counter {GRAINS, TOPPLES, SWEEPS, EMPTY_SWEEPS, SITE_CHECKS, RNG_DRAWS, RNG_CALLS};
+enum Phase {DRIVE, RELAX, RECORD, RNG};
+
+template <bool instrumented>
+static int relax(int L, double p, long long n, long long *t_c, long long *height, uint8_t *z, uint8_t *zth, Threshold_Stream &rng, long long *counters)
+{
+	// relaxes the pile by sweeping over every site until it is stable,
+	// returning the avalanche size. The pile is held as the slope z of each
+	// site and the height of site 1. n is the number of this iteration,
+	// recorded in t_c[0] when the first grain leaves. The counting is compiled
+	// out of the uninstrumented version.
+	bool relax = true;
+	int s = 0;
+	while (relax == true){
+		relax = false;
+		for (int j = 0; j < L; j++){
+			if (z[j] > zth[j]){
+				if (j < L - 1){
+					z[j] -= 2;
+					z[j + 1] += 1;
+				}
+				else{
+					z[j] -= 1;
+					if (t_c[0] < 0){
+						t_c[0] = n;
 					}
-					s += 1;
-					zth[j] = set_thr(p);
-					relax = true;
 				}
+				if (j > 0){
+					z[j - 1] += 1;
+				}
+				else{
+					height[0] -= 1;
+				}
+				s += 1;
+				zth[j] = (uint8_t)set_thr(rng, p);
+				relax = true;
 			}
 		}
+		if (instrumented){
+			counters[SWEEPS] += 1;
+			counters[SITE_CHECKS] += L;
+		}
+	}
+	if (instrumented){
+		// the final sweep of every avalanche finds no unstable site
+		counters[GRAINS] += 1;
+		counters[EMPTY_SWEEPS] += 1;
+		counters[TOPPLES] += s;
+		counters[RNG_DRAWS] += s;
+		counters[RNG_CALLS] += s;
+	}
+	return s;
+}
+
+static int drive_relax(int L, double p, long long n, long long *t_c, long long *height, uint8_t *z, uint8_t *zth, Threshold_Stream &rng)
+{
+	// drives the pile at site 1 and relaxes it, returning the avalanche size
+	height[0] += 1; //drive phase
+	z[0] += 1;
+	return relax<false>(L, p, n, t_c, height, z, zth, rng, NULL); //relaxation phase
+}
+
+OSLO_EXPORT void oslo_chunk(int N, int L, double p, long long *count, long long *t_c, long long *height, uint8_t *z, uint64_t *thresholds, uint64_t *rng_state, int *heights, unsigned int *avalanche_sizes)
+{
+	// runs N iterations starting from the pile state (height, z, thresholds),
+	// generator state and iteration count passed in, and writes the state back
+	// so that a run can be continued by calling oslo_chunk again. t_c[0] < 0
+	// until the first grain leaves the system. heights and avalanche_sizes
+	// hold the output of this chunk only.
+	Threshold_Stream rng;
+	for (int i = 0; i < 4; i++){
+		rng.s[i] = rng_state[i];
+	}
+	std::vector<uint8_t> zth(L);
+	unpack_thr(L, thresholds, zth.data());
+
+	for (int i = 0; i < N; i++){
+		avalanche_sizes[i] = drive_relax(L, p, count[0] + i, t_c, height, z, zth.data(), rng);
+		heights[i] = (int)height[0];
+	}
+
+	count[0] += N;
+	pack_thr(L, zth.data(), thresholds);
+	for (int i = 0; i < 4; i++){
+		rng_state[i] = rng.s[i];
+	}
+}
+
+OSLO_EXPORT void oslo_chunk_instrumented(int N, int L, double p, long long *count, long long *t_c, long long *height, uint8_t *z, uint64_t *thresholds, uint64_t *rng_state, int *heights, unsigned int *avalanche_sizes, long long *counters, double *times)
+{
+	// oslo_chunk, also adding the counts of each Counter to counters and the
+	// wall time of each Phase in seconds to times. Kept separate from
+	// oslo_chunk so that the uninstrumented kernel has no overhead.
+	typedef std::chrono::steady_clock clock;
+	Threshold_Stream rng;
+	for (int i = 0; i < 4; i++){
+		rng.s[i] = rng_state[i];
+	}
+	std::vector<uint8_t> zth(L);
+	unpack_thr(L, thresholds, zth.data());
+	long long draws = counters[RNG_DRAWS];
+
+	for (int i = 0; i < N; i++){
+		clock::time_point start = clock::now();
+		height[0] += 1;
+		z[0] += 1;
+		clock::time_point driven = clock::now();
+		int s = relax<true>(L, p, count[0] + i, t_c, height, z, zth.data(), rng, counters);
+		clock::time_point relaxed = clock::now();
 		avalanche_sizes[i] = s;
-		heights[i] = h[0];
+		heights[i] = (int)height[0];
+		times[DRIVE] += std::chrono::duration<double>(driven - start).count();
+		times[RELAX] += std::chrono::duration<double>(relaxed - driven).count();
+		times[RECORD] += std::chrono::duration<double>(clock::now() - relaxed).count();
 	}
-	double z_mean = (double)h[0] / (double)L;
-	t_c_theory[0] = (z_mean / 2) * pow(L, 2.0) * (1.0 + (1.0 / L));
 
+	count[0] += N;
+	pack_thr(L, zth.data(), thresholds);
+	for (int i = 0; i < 4; i++){
+		rng_state[i] = rng.s[i];
+	}
+
+	// the generator is too fast to time draw by draw, so the part of the
+	// relaxation time it takes is estimated by timing as many draws from a
+	// copy of the generator
+	Threshold_Stream copy = rng;
+	volatile int sink = 0; // keeps the draws from being optimised away
+	clock::time_point start = clock::now();
+	for (long long k = counters[RNG_DRAWS] - draws; k > 0; k--){
+		sink = sink + set_thr(copy, p);
+	}
+	times[RNG] += std::chrono::duration<double>(clock::now() - start).count();
+}
+
+OSLO_EXPORT void oslo_transient(int L, double p, long long *count, long long *t_c, long long *height, uint8_t *z, uint64_t *thresholds, uint64_t *rng_state)
+{
+	// runs iterations from the state passed in until the first grain leaves
+	// the system, without storing any output, and writes the state back
+	Threshold_Stream rng;
+	for (int i = 0; i < 4; i++){
+		rng.s[i] = rng_state[i];
+	}
+	std::vector<uint8_t> zth(L);
+	unpack_thr(L, thresholds, zth.data());
+
+	while (t_c[0] < 0){
+		drive_relax(L, p, count[0], t_c, height, z, zth.data(), rng);
+		count[0] += 1;
+	}
+
+	pack_thr(L, zth.data(), thresholds);
+
+	for (int i = 0; i < 4; i++){
+		rng_state[i] = rng.s[i];
+	}
+}
+
+OSLO_EXPORT void oslo_skip(long long N, int L, double p, long long *count, long long *t_c, long long *height, uint8_t *z, uint64_t *thresholds, uint64_t *rng_state)
+{
+	// runs N iterations from the state passed in without storing any output,
+	// and writes the state back
+	Threshold_Stream rng;
+	for (int i = 0; i < 4; i++){
+		rng.s[i] = rng_state[i];
+	}
+	std::vector<uint8_t> zth(L);
+	unpack_thr(L, thresholds, zth.data());
+
+	for (long long n = 0; n < N; n++){
+		drive_relax(L, p, count[0], t_c, height, z, zth.data(), rng);
+		count[0] += 1;
+	}
+
+	pack_thr(L, zth.data(), thresholds);
+
+	for (int i = 0; i < 4; i++){
+		rng_state[i] = rng.s[i];
+	}
+}
+
+static void run_job(int L, int N, double p, uint64_t *rng_state, bool recurrent_only, long long *t_c, long long *height, int *heights, unsigned int *avalanche_sizes, long long *h_sums, std::vector<int> &scratch)
+{
+	// runs one system from an empty pile as Kernel_System.iterate does, the
+	// generator state passed in being advanced. heights may be NULL, in which
+	// case the heights of each chunk go to scratch and are only summed.
+	long long count = 0;
+	t_c[0] = -1;
+	height[0] = 0;
+	std::vector<uint8_t> z(L, 0);
+	std::vector<uint64_t> thresholds((L + 63) / 64, 0);
+	oslo_init(L, p, thresholds.data(), rng_state);
+	if (recurrent_only){
+		oslo_transient(L, p, &count, t_c, height, z.data(), thresholds.data(), rng_state);
+	}
+	long long origin = count;
+	h_sums[0] = 0;
+	h_sums[1] = 0;
+	int chunk = heights == NULL ? (int)scratch.size() : N;
+	for (int start = 0; start < N; start += chunk){
+		int n = std::min(chunk, N - start);
+		int *chunk_heights = heights == NULL ? scratch.data() : heights + start;
+		oslo_chunk(n, L, p, &count, t_c, height, z.data(), thresholds.data(), rng_state,
+		           chunk_heights, avalanche_sizes + start);
+		// sums of h and h^2 over the recurrent iterations of the chunk
+		if (t_c[0] >= 0){
+			long long first = std::max(t_c[0] - origin - start, 0LL);
+			for (long long i = first; i < n; i++){
+				h_sums[0] += chunk_heights[i];
+				h_sums[1] += (long long)chunk_heights[i] * chunk_heights[i];
+			}
+		}
+	}
+}
+
+OSLO_EXPORT void oslo_jobs(int n_jobs, const int *L, int N, double p, uint64_t *rng_states, int recurrent_only, int n_threads, long long *t_c, long long *height, int *heights, unsigned int *avalanche_sizes, long long *h_sums)
+{
+	// runs n_jobs independent systems of size L[j], each for N iterations
+	// from the generator state rng_states[4j..4j+3], over n_threads threads
+	// which take the jobs in order. The outputs of job j are t_c[j], the
+	// final height[j], heights and avalanche_sizes[jN..jN+N-1] and the
+	// recurrent sums of h and h^2 in h_sums[2j], h_sums[2j+1]. heights may be
+	// NULL to only keep the sums. Called through ctypes, which releases the
+	// GIL for the duration of the call.
+	std::atomic<int> next(0);
+	auto worker = [&](){
+		std::vector<int> scratch(1 << 16);
+		for (int j = next++; j < n_jobs; j = next++){
+			run_job(L[j], N, p, rng_states + 4 * (long long)j, recurrent_only != 0, t_c + j, height + j,
+			        heights == NULL ? NULL : heights + (long long)j * N,
+			        avalanche_sizes + (long long)j * N, h_sums + 2 * (long long)j, scratch);
+		}
+	};
+	n_threads = std::max(1, std::min(n_threads, n_jobs));
+	std::vector<std::thread> threads;
+	for (int i = 1; i < n_threads; i++){
+		threads.emplace_back(worker);
+	}
+	worker();
+	for (std::thread &thread : threads){
+		thread.join();
+	}
 }
 
+OSLO_EXPORT void oslo(int N, int L, double p, int *t_c, double *t_c_theory, int *h, int *zth, int *heights, int *avalanche_sizes, uint64_t seed)
+{
+	// runs a whole system in one call, seeding the generator from seed so
+	// that the run can be repeated
+	uint64_t rng_state[4];
+	Threshold_Stream rng;
+	rng.seed(seed);
+	for (int i = 0; i < 4; i++){
+		rng_state[i] = rng.s[i];
+	}
+	long long count = 0;
+	long long t_c_chunk = -1;
+	long long height = 0;
+	std::vector<uint8_t> z(L, 0);
+	std::vector<uint64_t> thresholds((L + 63) / 64, 0);
+	oslo_init(L, p, thresholds.data(), rng_state);
+	oslo_chunk(N, L, p, &count, &t_c_chunk, &height, z.data(), thresholds.data(), rng_state, 
+	           heights, reinterpret_cast<unsigned int *>(avalanche_sizes));
+	if (t_c_chunk >= 0){
+		t_c[0] = (int)t_c_chunk;
+	}
+	// heights and thresholds of every site for the caller
+	h[L] = 0;
+	for (int i = L - 1; i >= 0; i--){
+		h[i] = h[i + 1] + z[i];
+		zth[i] = get_thr(thresholds.data(), i);
+	}
+	double z_mean = (double)height / (double)L;
+	t_c_theory[0] = (z_mean / 2) * pow(L, 2.0) * (1.0 + (1.0 / L));
+
+}
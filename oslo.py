@@ -1,19 +1,102 @@
 # -*- coding: utf-8 -*-
+import json
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from timeit import default_timer as timer
+from running_statistics import Running_Statistics
+from checkpoint import save_checkpoint, load_checkpoint, check_checkpoint, seed_record
+from instrumentation import Counters, GRAINS, TOPPLES, SWEEPS, EMPTY_SWEEPS, SITE_CHECKS, RNG_DRAWS, RNG_CALLS, DRIVE, RELAX, RECORD, RNG
 
+# grains per L**2 run after fast_forward, by which the pile has relaxed from
+# the recurrent configuration it builds to the stationary state (~0.15 L**2)
+burn_in = 0.2
+
+def burn_in_grains(L):
+    # number of grains run without storing anything after fast_forward
+    return int(np.ceil(burn_in * L**2))
+
+class Threshold_Stream:
+    '''
+    Threshold_Stream: pre-generated, block-refilled buffer of threshold gradients
+    drawn from a numpy Generator. A threshold gradient is 1 with probability p
+    and 2 otherwise, as with np.random.choice([1, 2], p=[p, 1-p]).
+    Important methods:
+        draw: returns the next threshold gradient.
+        draw_many: returns an array of the next n threshold gradients.
+    '''
+    
+    def __init__(self, p, rng, block=4096):
+        
+        '''
+        Args:
+            p: probability of a threshold gradient of 1.
+            rng: numpy Generator used to draw the thresholds.
+            block: number of thresholds generated each time the buffer is refilled.
+        '''
+        
+        self.p = p
+        self.rng = rng
+        self.block = block
+        self.refill()
+    
+    def refill(self):
+        # generates a new block of thresholds, held as a list for fast indexing
+        self.buffer = (1 + (self.rng.random(self.block) >= self.p)).tolist()
+        self.index = 0
+    
+    def draw(self):
+        # returns the next threshold gradient from the buffer
+        if self.index == self.block:
+            self.refill()
+        value = self.buffer[self.index]
+        self.index += 1
+        return value
+    
+    def draw_many(self, n):
+        # returns the next n threshold gradients from the buffer
+        return np.array([self.draw() for i in range(n)])
+
+class Counted_Threshold_Stream(Threshold_Stream):
+    # Threshold_Stream which adds its generator calls, the thresholds drawn
+    # and the time taken to generate them to an instrumentation.Counters
+    
+    def __init__(self, p, rng, counters, block=4096):
+        self.counters = counters
+        self.counted = 0 # thresholds of the current block added to the counters
+        super().__init__(p, rng, block)
+    
+    def refill(self):
+        if hasattr(self, 'buffer'):
+            self.flush()
+        start = timer()
+        super().refill()
+        self.counters.times[RNG] += timer() - start
+        self.counters.counts[RNG_CALLS] += 1
+        self.counted = 0
+    
+    def flush(self):
+        # adds the thresholds drawn since the last flush to the counters
+        self.counters.counts[RNG_DRAWS] += self.index - self.counted
+        self.counted = self.index
+    
 class System:
     '''
     System class for the Oslo model system. 
+    The pile is held as the slope z of each site (z_i = h_i - h_{i+1}), one
+    byte per site in a bytearray, together with the height of site 1. The 
+    heights of every site are available as the h property.
     Important methods: 
         drive: drives the model one iteration
         relax: carries out one relaxation
         iterate: iterates the model through required number of iterations
     '''
     
-    def __init__(self, L, p=0.5, animate=False): 
+    engines = ('stack', 'sweep') # available relaxation engines
+    frame_time = 0.04 # minimum time between animation frames in seconds
+    
+    def __init__(self, L, p=0.5, animate=False, engine='stack', seed=None, instrument=False): 
         
         '''
         Initialises an Oslo Model System
@@ -22,24 +105,70 @@ class System:
             L: system size e.g. number of sites. 
             p: probability of a threshold gradient of 1, used to set threshold values. 
             animate: runs animation or not.
+            engine: relaxation engine, 'stack' only re-checks the neighbours of 
+                    toppled sites, 'sweep' sweeps every site until the pile is
+                    stable (reference implementation).
+            seed: int, None or np.random.SeedSequence used to seed the random
+                  number generator which draws threshold gradients. None
+                  draws fresh entropy, which is recorded in self.seed.
+            instrument: if True, counts topples, sweeps, site checks and
+                        threshold draws and times each phase of iterate in
+                        self.counters (instrumentation.Counters). The
+                        instrumented methods are only bound when enabled, so
+                        an uninstrumented system runs the same code as before.
         '''
+        
+        if engine not in self.engines:
+            raise ValueError('Unknown relaxation engine: {}'.format(engine))
             
         self.L = L 
         self.p = p # probability of seting a threshold value of 1
         self.animate = animate 
-        self.h = np.zeros(L + 1) # array to hold value of height at each site, height at L+1=0
-        self.zth = np.zeros(L)
+        self.engine = engine
+        # relaxation method used by iterate
+        self.relax = self.relax_stack if engine == 'stack' else self.relax_sweep
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed # seed sequence the run can be repeated from
+        self.rng = np.random.default_rng(seed)
+        self.counters = None # hot path counters of an instrumented system
+        if instrument:
+            self.counters = Counters()
+            self.relax = self.relax_stack_counted if engine == 'stack' else self.relax_sweep_counted
+            self.run_chunk = self.run_chunk_counted
+            self.thresholds = Counted_Threshold_Stream(p, self.rng, self.counters)
+        else:
+            self.thresholds = Threshold_Stream(p, self.rng) # source of threshold gradients
+        self.z = bytearray(L) # slope at each site, never negative
+        self.zth = bytearray(L) # threshold slope at each site
+        self.height = 0 # height of site 1
         self.count = 0 # counts number of iterations
         self.t_c = None # crossover time not yet reached
+        self.origin = 0 # iteration stored at index 0 of heights and avalanche_sizes
         
         self.recurrent = False # boolean to remember if the system has reached recurrent phase
     
+    @property
+    def h(self):
+        # height at each site, height at L+1=0
+        h = np.zeros(self.L + 1, np.int64)
+        h[:-1] = np.cumsum(np.frombuffer(self.z, np.uint8)[::-1])[::-1]
+        return h
+    
+    def set_h(self, h):
+        # sets the pile from the height at each site
+        h = np.asarray(h, np.int64)
+        np.frombuffer(self.z, np.uint8)[:] = h[:-1] - h[1:]
+        self.height = int(h[0])
+    
     def drive(self):
         # drive method
-        self.h[0] += 1
+        self.z[0] += 1
+        self.height += 1
         
-    def relax(self, n):
-        # relaxation method
+    def relax_sweep(self):
+        # relaxation method, sweeps over all sites until no site is unstable
+        z = self.z
         relax = True # assume relaxation is necessary
         s=0 # reset avalanche size
         while relax == True: 
@@ -47,52 +176,349 @@ class System:
             relax = False # no sites have yet relaxed
             
             for i in range(self.L): # cycle over each site in the systme
-                z = self.h[i] - self.h[i + 1] # calculate gradient at each site
-                if z > self.zth[i]: # compare to threshold gradient
+                if z[i] > self.zth[i]: # compare gradient to threshold gradient
                     if i < self.L - 1: # check non-final sites
-                        self.h[i] -= 1
-                        self.h[i + 1] += 1
+                        z[i] -= 2
+                        z[i + 1] += 1
                     else: # check final site
-                        self.h[i] -= 1
+                        z[i] -= 1
                         if self.recurrent == False: # check if recurrent phase already reached    
                             self.t_c = self.count # if not, calculate t_c value
                             self.recurrent = True # recurrent phase has been reached
+                    if i > 0: # gradient of the previous site has increased
+                        z[i - 1] += 1
+                    else: # grain has left site 1
+                        self.height -= 1
     
                     s += 1 # increment avalanche size
                     # reset threshold value for relaxed sites
-                    self.zth[i] = np.random.choice([1, 2], p=[self.p, 1-self.p]) 
+                    self.zth[i] = self.thresholds.draw()
                     # relaxation has occured
                     relax = True
-        self.avalanche_sizes[n] = s # store avalanche size
-            
+        return s
+    
+    def relax_stack(self):
+        # relaxation method, keeps a stack of sites which may be unstable and
+        # only re-checks the neighbours of a toppled site, so the cost of an
+        # avalanche scales with its size rather than with L
+        z = self.z
+        zth = self.zth
+        L = self.L
+        draw = self.thresholds.draw
+        s = 0 # reset avalanche size
+        stack = [0] # only the driven site can be unstable after a drive
+        while stack:
+            i = stack.pop()
+            if z[i] > zth[i]: # compare gradient to threshold gradient
+                if i < L - 1: # non-final sites pass the grain on
+                    z[i] -= 2
+                    z[i + 1] += 1
+                    stack.append(i + 1)
+                else: # final site, grain leaves the system
+                    z[i] -= 1
+                    if self.recurrent == False:
+                        self.t_c = self.count # crossover time reached
+                        self.recurrent = True
+                if i > 0: # gradient of the previous site has increased
+                    z[i - 1] += 1
+                    stack.append(i - 1)
+                else: # grain has left site 1
+                    self.height -= 1
+                stack.append(i) # site may still be above its new threshold
+                
+                s += 1 # increment avalanche size
+                # reset threshold value for relaxed site
+                zth[i] = draw()
+        return s
+    
+    def relax_sweep_counted(self):
+        # relax_sweep, also counting sweeps and site checks
+        z = self.z
+        zth = self.zth
+        L = self.L
+        draw = self.thresholds.draw
+        s = 0
+        sweeps = 0
+        relax = True
+        while relax:
+            relax = False
+            sweeps += 1
+            for i in range(L):
+                if z[i] > zth[i]:
+                    if i < L - 1:
+                        z[i] -= 2
+                        z[i + 1] += 1
+                    else:
+                        z[i] -= 1
+                        if self.recurrent == False:
+                            self.t_c = self.count
+                            self.recurrent = True
+                    if i > 0:
+                        z[i - 1] += 1
+                    else:
+                        self.height -= 1
+                    s += 1
+                    zth[i] = draw()
+                    relax = True
+        counts = self.counters.counts
+        counts[GRAINS] += 1
+        counts[TOPPLES] += s
+        counts[SWEEPS] += sweeps
+        counts[EMPTY_SWEEPS] += 1 # the final sweep finds no unstable site
+        counts[SITE_CHECKS] += sweeps * L
+        return s
+    
+    def relax_stack_counted(self):
+        # relax_stack, also counting site checks
+        z = self.z
+        zth = self.zth
+        L = self.L
+        draw = self.thresholds.draw
+        s = 0
+        checks = 0
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            checks += 1
+            if z[i] > zth[i]:
+                if i < L - 1:
+                    z[i] -= 2
+                    z[i + 1] += 1
+                    stack.append(i + 1)
+                else:
+                    z[i] -= 1
+                    if self.recurrent == False:
+                        self.t_c = self.count
+                        self.recurrent = True
+                if i > 0:
+                    z[i - 1] += 1
+                    stack.append(i - 1)
+                else:
+                    self.height -= 1
+                stack.append(i)
+                s += 1
+                zth[i] = draw()
+        counts = self.counters.counts
+        counts[GRAINS] += 1
+        counts[TOPPLES] += s
+        counts[SITE_CHECKS] += checks
+        return s
                 
-    def iterate(self, N=10**4):
-        # iteration method, should be called with required number of iterations
+    def run_to_recurrence(self):
+        # iterates the model without storing anything until the first grain
+        # leaves the system, i.e. through the transient phase
+        while self.recurrent == False:
+            self.drive()
+            self.relax()
+            self.count += 1
+    
+    def fast_forward(self):
+        # builds a recurrent configuration directly instead of running through
+        # the transient phase: every gradient is set equal to its threshold
+        # gradient, which is stable and has no site of zero gradient, so it is
+        # recurrent. The crossover time is recorded as 0. Its thresholds
+        # average 1.5 rather than the stationary ~1.72, so burn_in * L**2
+        # grains are run without storing anything to reach the stationary state.
+        self.z[:] = self.zth
+        self.height = sum(self.zth)
+        self.t_c = 0
+        self.recurrent = True
+        for n in range(burn_in_grains(self.L)):
+            self.drive()
+            self.relax()
+            self.count += 1
+    
+    def iterate(self, N=10**4, stream=False, chunk_size=10**5, checkpoint=None, store=None,
+                recurrent_only=False, fast_forward=False, resume=False):
+        '''
+        Iterates the model N times.
+        
+        Args:
+            N: number of iterations, or of recurrent samples if recurrent_only.
+            stream: if True, only running statistics of the recurrent phase are
+                    kept (self.statistics) instead of the full heights and
+                    avalanche_sizes arrays, so memory does not grow with N.
+            chunk_size: number of iterations between updates of the running 
+                        statistics and between checkpoints.
+            checkpoint: file name of a checkpoint. If the file exists the run is
+                        resumed from it, and it is rewritten after every chunk.
+            store: data_store.Data_Store which the recurrent heights and
+                   avalanche sizes are appended to after every chunk.
+            recurrent_only: if True, the transient phase is run without storing
+                            anything and N samples are taken after t_c, so
+                            heights and avalanche_sizes only hold recurrent data.
+            fast_forward: if True, the transient phase is skipped altogether by
+                          building a recurrent configuration directly and
+                          running its burn-in (see fast_forward), implies
+                          recurrent_only. t_c is then 0.
+            resume: if True, the model continues from its current pile and
+                    thresholds, left by an earlier call of iterate, instead of
+                    starting from an empty pile. heights, avalanche_sizes and
+                    statistics then only hold the N new iterations.
+        '''
         self.N = N
-        # numpy arrays to hold avalanche sizes and heights
-        self.avalanche_sizes = np.zeros(N)
-        self.heights = np.zeros(N)
-        # sets initial threshold gradients
-        for i in range(self.L): 
-            self.zth[i] = np.random.choice([1, 2], p=[self.p, 1-self.p])
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_checkpoint(checkpoint, stream, store)
+        else:
+            # numpy arrays to hold avalanche sizes and heights
+            if stream:
+                self.statistics = Running_Statistics()
+            else:
+                self.avalanche_sizes = np.zeros(N, np.uint32)
+                self.heights = np.zeros(N, np.int32)
+            if resume:
+                self.origin = self.count # samples are only stored from here
+            else:
+                # sets initial threshold gradients
+                self.zth[:] = bytes(self.thresholds.draw_many(self.L).astype(np.uint8))
+                if fast_forward:
+                    self.fast_forward()
+                elif recurrent_only:
+                    self.run_to_recurrence()
+                if recurrent_only or fast_forward:
+                    self.origin = self.count # samples are only stored from here
+        if stream: # buffers are only one chunk long when streaming
+            self.avalanche_sizes = np.zeros(min(N, chunk_size), np.uint32)
+            self.heights = np.zeros(min(N, chunk_size), np.int32)
         
         if self.animate == True:
-            fig, ax = plt.subplots()
+            self.start_animation()
+        
+        # iterates over required number of iterations, in chunks when streaming
+        # or checkpointing
+        chunked = stream or checkpoint is not None or store is not None
+        step = min(N, chunk_size) if chunked else N
+        end = self.origin + N
+        for start in range(self.count, end, max(step, 1)):
+            stop = min(start + step, end)
+            offset = start if stream else self.origin # index of the chunk in the buffers
+            self.run_chunk(start, stop, offset, stream, store)
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint, stream, store)
         
-        # iterates over required number of iterations
-        for n in range(N):
+        if stream: # buffers only hold the final chunk so are discarded
+            self.heights = None
+            self.avalanche_sizes = None
+    
+    def run_chunk(self, start, stop, offset, stream=False, store=None):
+        # runs iterations start to stop, storing them from index start - offset
+        # of the buffers, then records the chunk
+        for n in range(start, stop):
             
             self.drive() # relaxation phase
-            self.relax(n) # drive phase
-            self.heights[n] = self.h[0] # stores height value history
+            self.avalanche_sizes[n - offset] = self.relax() # drive phase
+            self.heights[n - offset] = self.height # stores height value history
             self.count += 1 # increments iteration number
             if self.animate == True: # animation loop if required
-                ax.clear()
-                #ax.bar(range(self.L),self.h[:-1], width = 1.0)
-                ax.plot(range(self.L),self.h[:-1], marker='o', markerfacecolor='red')
-                #fig.canvas.draw()
-                plt.pause(0.01)
+                self.draw_frame()
+        self.record_chunk(start, stop - start, stream, store)
+    
+    def run_chunk_counted(self, start, stop, offset, stream=False, store=None):
+        # run_chunk, also timing the drive, relax and record phases
+        times = self.counters.times
+        for n in range(start, stop):
+            t_0 = timer()
+            self.drive()
+            t_1 = timer()
+            self.avalanche_sizes[n - offset] = self.relax()
+            t_2 = timer()
+            self.heights[n - offset] = self.height
+            self.count += 1
+            times[DRIVE] += t_1 - t_0
+            times[RELAX] += t_2 - t_1
+            times[RECORD] += timer() - t_2
+            if self.animate == True:
+                self.draw_frame()
+        t_0 = timer()
+        self.record_chunk(start, stop - start, stream, store)
+        times[RECORD] += timer() - t_0
+        self.thresholds.flush()
     
+    def start_animation(self):
+        # sets up the animation, the pile is redrawn by updating a single line
+        fig, ax = plt.subplots()
+        #ax.bar(range(self.L),self.h[:-1], width = 1.0)
+        self.animation_line, = ax.plot(range(self.L), self.h[:-1], marker='o', markerfacecolor='red')
+        self.animation_axes = ax
+        self.last_frame = timer()
+    
+    def draw_frame(self):
+        # redraws the pile, at most once every frame_time seconds so the
+        # animation does not limit the speed of the simulation
+        if timer() - self.last_frame < self.frame_time:
+            return
+        self.animation_line.set_ydata(self.h[:-1])
+        self.animation_axes.relim()
+        self.animation_axes.autoscale_view()
+        plt.pause(0.001)
+        self.last_frame = timer()
+    
+    def record_chunk(self, start, n, stream=False, store=None):
+        # folds the recurrent part of the n iterations starting at iteration 
+        # start into the running statistics and appends it to the store
+        if self.recurrent == False:
+            return
+        offset = start if stream else self.origin # index of the chunk in the buffers
+        first = max(self.t_c - start, 0) + start - offset
+        heights = self.heights[first:start - offset + n]
+        avalanche_sizes = self.avalanche_sizes[first:start - offset + n]
+        if stream:
+            self.statistics.update(heights, avalanche_sizes)
+        if store is not None:
+            if store.metadata.get('t_c') is None:
+                store.update_metadata(t_c=self.t_c)
+            store.append(heights, avalanche_sizes)
+    
+    def save_checkpoint(self, path, stream=False, store=None):
+        # saves the pile state, random number generator state and outputs so
+        # far, so that iterate can resume the run from the checkpoint
+        state = {'L': self.L, 'p': self.p, 'N': self.N, 'stream': stream,
+                 'count': self.count, 't_c': -1 if self.t_c is None else self.t_c,
+                 'origin': self.origin, 'seed': seed_record(self.seed),
+                 'z': np.frombuffer(self.z, np.uint8), 
+                 'zth_bits': np.packbits(np.frombuffer(self.zth, np.uint8) - 1), # threshold 1 or 2 as a bit
+                 'rng_state': json.dumps(self.rng.bit_generator.state),
+                 'threshold_buffer': self.thresholds.buffer, 
+                 'threshold_index': self.thresholds.index,
+                 'store_n': -1 if store is None else len(store)}
+        if stream:
+            state.update(self.statistics.state())
+        else:
+            state['heights'] = self.heights[:self.count - self.origin]
+            state['avalanche_sizes'] = self.avalanche_sizes[:self.count - self.origin]
+        save_checkpoint(path, state)
+    
+    def load_checkpoint(self, path, stream=False, store=None):
+        # restores a run saved by save_checkpoint, discarding any data appended
+        # to the store after the checkpoint was written
+        state = load_checkpoint(path)
+        check_checkpoint(state, L=self.L, p=self.p, N=self.N, stream=stream)
+        if 'seed' in state: # not recorded by older checkpoints
+            check_checkpoint(state, seed=seed_record(self.seed))
+        if store is not None and state['store_n'] >= 0:
+            store.truncate(int(state['store_n']))
+        self.count = int(state['count'])
+        self.t_c = None if state['t_c'] < 0 else int(state['t_c'])
+        self.recurrent = self.t_c is not None
+        self.origin = int(state.get('origin', 0))
+        if 'z' in state:
+            self.z[:] = bytes(state['z'])
+            self.height = int(np.sum(state['z']))
+            self.zth[:] = bytes(1 + np.unpackbits(state['zth_bits'], count=self.L))
+        else: # checkpoints from before slopes were stored
+            self.set_h(state['h'])
+            self.zth[:] = bytes(state['zth'].astype(np.uint8))
+        self.rng.bit_generator.state = json.loads(str(state['rng_state']))
+        self.thresholds.buffer = state['threshold_buffer'].tolist()
+        self.thresholds.index = int(state['threshold_index'])
+        if stream:
+            self.statistics = Running_Statistics()
+            self.statistics.load_state(state)
+        else:
+            self.heights = np.zeros(self.N, np.int32)
+            self.avalanche_sizes = np.zeros(self.N, np.uint32)
+            self.heights[:self.count - self.origin] = state['heights']
+            self.avalanche_sizes[:self.count - self.origin] = state['avalanche_sizes']
     
     def heights(self):
         return self.heights
@@ -102,23 +528,30 @@ class System:
     
     def z_mean(self): 
         # calculates average gradient of pile
-        return self.h[0]/self.L
+        return self.height/self.L
     
     def t_c_theory(self):
         # calculates theoretical crossover time
         return (self.z_mean() / 2) * self.L**2 * (1. + 1. / self.L)
     
+    def recurrent_start(self):
+        # index of the first recurrent sample in the buffers, the end of the
+        # buffers if t_c was not reached so that there are no recurrent samples
+        if self.t_c is None:
+            return len(self.heights)
+        return max(self.t_c - self.origin, 0)
+    
     def recurrent_s(self): 
         # cuts off avalanche sizes at t_c for recurrent avalanche sizes
-        return self.avalanche_sizes[self.t_c:]
+        return self.avalanche_sizes[self.recurrent_start():]
     
     def recurrent_h(self):
         # cuts of height history at t_c for recurrent heights
-        return self.heights[self.t_c:]
+        return self.heights[self.recurrent_start():]
     
     def mean_recurrent_h(self):
         # calculates mean recurrent height 
-        return sum(self.recurrent_h())/len(self.recurrent_h())
+        return np.mean(self.recurrent_h())
     
     
 
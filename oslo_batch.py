@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+class Batch_System:
+    '''
+    Batch_System class for M independent Oslo model systems of the same size,
+    advanced together with vectorised numpy operations.
+    All replicas are relaxed together by toppling every unstable site in 
+    parallel. The Oslo model is abelian, so parallel toppling gives the same
+    statistics as relaxing each pile on its own.
+    As in oslo.System each pile is held as the slope of each site (one byte
+    per site) and the height of site 1.
+    Each replica draws its thresholds from its own random stream, buffered in
+    blocks as by oslo.Threshold_Stream, taking a row of L thresholds on every
+    relaxation pass. A replica's number of passes depends only on its own run,
+    so its output depends only on its own seed and not on M or on the other
+    replicas.
+    This is a reference vectorised engine rather than a fast one: every pass
+    has a fixed numpy overhead and scans every site of every replica, so it
+    is usually slower than running oslo.System serially unless M is large.
+    Use oslo.System or oslo_kernel.Kernel_System for speed.
+    Important methods:
+        drive: drives the given replicas one iteration
+        relax: carries out one parallel toppling pass over every replica
+        iterate: iterates the replicas through required number of iterations
+    '''
+
+    def __init__(self, L, M, p=0.5, seed=None):
+
+        '''
+        Initialises a batch of Oslo Model Systems
+
+        Args:
+            L: system size e.g. number of sites.
+            M: number of independent replicas.
+            p: probability of a threshold gradient of 1, used to set threshold values.
+            seed: int, None or np.random.SeedSequence from which replica m
+                  gets the stream of child m, or a list of M seeds, one for
+                  each replica. None draws fresh entropy.
+        '''
+
+        self.L = L
+        self.M = M
+        self.p = p
+        if isinstance(seed, (list, tuple)):
+            if len(seed) != M:
+                raise ValueError('Expected {} replica seeds, got {}.'.format(M, len(seed)))
+            self.seeds = [s if isinstance(s, np.random.SeedSequence) else np.random.SeedSequence(s)
+                          for s in seed]
+        else:
+            root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+            # children of the root, as root.spawn(M) without advancing it
+            self.seeds = [np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (m,))
+                          for m in range(M)]
+        self.rngs = [np.random.default_rng(s) for s in self.seeds] # stream of each replica
+        # block of pre-generated rows of L thresholds of each replica, all
+        # replicas taking the row self.row on the same pass
+        self.rows = max(16, 2**16 // L)
+        self.buffer = np.zeros((M, self.rows, L), np.uint8)
+        self.row = self.rows
+        self.z = np.zeros((M, L), np.uint8) # slopes of each replica
+        self.zth = np.zeros((M, L), np.uint8) # threshold gradients of each replica
+        self.height = np.zeros(M, np.int64) # height of site 1 of each replica
+        self.count = np.zeros(M, np.int64) # counts number of iterations of each replica
+        self.t_c = [None] * M # crossover time of each replica not yet reached
+
+        self.recurrent = np.zeros(M, bool) # replicas which have reached the recurrent phase
+        self.all_recurrent = False
+        self.loss = np.full(L, 2, np.uint8) # slope lost by a toppling site
+        self.loss[-1] = 1
+
+    def generate(self, m, n):
+        # generates n threshold gradients of replica m, 1 with probability p and 2 otherwise
+        return (1 + (self.rngs[m].random(n) >= self.p)).astype(np.uint8)
+    
+    def draw(self):
+        '''
+        draw: the next row of threshold gradients of every replica, one for
+        each site. Toppled sites take theirs and the rest are discarded, which
+        is cheaper than gathering a different number for each replica.
+        Returns:
+            thresholds: (M, L) array of threshold gradients.
+        '''
+        
+        if self.row == self.rows:
+            for m in range(self.M):
+                self.buffer[m] = self.generate(m, self.rows * self.L).reshape(self.rows, self.L)
+            self.row = 0
+        thresholds = self.buffer[:, self.row]
+        self.row += 1
+        return thresholds
+    
+    @property
+    def h(self):
+        # heights of each replica, height at L+1=0
+        h = np.zeros((self.M, self.L + 1), np.int64)
+        h[:, :-1] = np.cumsum(self.z[:, ::-1], axis=1)[:, ::-1]
+        return h
+
+    def drive(self, replicas):
+        # drive method, adds a grain to site 1 of the replicas in the bool
+        # array replicas
+        self.z[:, 0] += replicas
+        self.height += replicas
+
+    def relax(self, unstable):
+        # relaxation method, topples every unstable site of every replica in
+        # parallel
+        z = self.z
+        topple = unstable.view(np.uint8)
+        # a toppling site loses a grain to each side, the final site's grain
+        # leaving the system, and gains one from each toppling neighbour
+        z -= topple * self.loss
+        z[:, 1:] += topple[:, :-1]
+        z[:, :-1] += topple[:, 1:]
+        self.height -= topple[:, 0]
+        if not self.all_recurrent:
+            leaving = unstable[:, -1] & ~self.recurrent
+            for m in leaving.nonzero()[0]:
+                self.t_c[m] = int(self.count[m]) # crossover time reached
+            self.recurrent |= leaving
+            self.all_recurrent = self.recurrent.all()
+        # reset threshold values for relaxed sites
+        np.copyto(self.zth, self.draw(), where=unstable)
+
+    def iterate(self, N=10**4):
+        # iteration method, should be called with required number of iterations.
+        # Replicas are not held in lock-step: as soon as a replica is stable its
+        # iteration is recorded and it is driven again, so every relaxation pass
+        # does useful work for all replicas which have not yet finished.
+        self.N = N
+        M = self.M
+        # numpy arrays to hold avalanche sizes and heights of each replica
+        self.avalanche_sizes = np.zeros((M, N), np.uint32)
+        self.heights = np.zeros((M, N), np.int32)
+        # sets initial threshold gradients
+        self.zth[:] = self.draw()
+        
+        s = np.zeros(M, np.int64) # avalanche size of each replica's current iteration
+        running = np.ones(M, bool) # replicas which have not completed N iterations
+        self.drive(running)
+        while True:
+            unstable = self.z > self.zth
+            # avalanche size increment of each replica
+            topples = unstable.view(np.uint8).sum(axis=1, dtype=np.int64)
+            # replicas with no unstable site have finished relaxing
+            finished = running & (topples == 0)
+            stable = finished.nonzero()[0]
+            if stable.size > 0:
+                n = self.count[stable]
+                self.avalanche_sizes[stable, n] = s[stable] # store avalanche sizes
+                self.heights[stable, n] = self.height[stable] # stores height value history
+                np.copyto(s, 0, where=finished)
+                self.count += finished # increments iteration number
+                running &= self.count < N
+                if not running.any():
+                    break
+                self.drive(finished & running) # drive phase of next iteration
+            self.relax(unstable) # relaxation phase
+            s += topples
+
+    def z_mean(self):
+        # calculates average gradient of each pile
+        return self.height / self.L
+
+    def t_c_theory(self):
+        # calculates theoretical crossover time of each replica
+        return (self.z_mean() / 2) * self.L**2 * (1. + 1. / self.L)
+
+    def recurrent_start(self, m):
+        # index of the first recurrent sample of replica m, the end of the
+        # buffers if t_c was not reached
+        return self.heights.shape[1] if self.t_c[m] is None else self.t_c[m]
+
+    def recurrent_s(self, m):
+        # cuts off avalanche sizes of replica m at t_c for recurrent avalanche sizes
+        return self.avalanche_sizes[m, self.recurrent_start(m):]
+
+    def recurrent_h(self, m):
+        # cuts of height history of replica m at t_c for recurrent heights
+        return self.heights[m, self.recurrent_start(m):]
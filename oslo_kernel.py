@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import os
+import shutil
+import subprocess
+import sys
+import warnings
+import numpy as np
+import numpy.ctypeslib as ctl
+from running_statistics import Running_Statistics
+from checkpoint import save_checkpoint, load_checkpoint, check_checkpoint, seed_record
+from instrumentation import Counters, RNG_DRAWS, RNG_CALLS, RECORD
+from oslo import burn_in_grains
+from timeit import default_timer as timer
+
+# directory holding oslo.cpp and the compiled library
+directory = os.path.dirname(os.path.abspath(__file__))
+source = os.path.join(directory, 'oslo.cpp')
+
+_library = None # library is only loaded once per process
+_load_attempted = False
+
+# integer arrays passed to the kernel must match the size of a C int
+int_array = ctl.ndpointer(dtype=np.intc, flags='C_CONTIGUOUS')
+uint_array = ctl.ndpointer(dtype=np.uintc, flags='C_CONTIGUOUS')
+uint8_array = ctl.ndpointer(dtype=np.uint8, flags='C_CONTIGUOUS')
+double_array = ctl.ndpointer(dtype=np.double, flags='C_CONTIGUOUS')
+int64_array = ctl.ndpointer(dtype=np.int64, flags='C_CONTIGUOUS')
+uint64_array = ctl.ndpointer(dtype=np.uint64, flags='C_CONTIGUOUS')
+
+def library_names():
+    '''
+    library_names: file names of the compiled kernel for this platform, in
+    order of preference.
+    '''
+
+    if sys.platform.startswith('win'):
+        return ['oslo.dll']
+    if sys.platform == 'darwin':
+        return ['liboslo.dylib', 'liboslo.so']
+    return ['liboslo.so']
+
+def build_library():
+    '''
+    build_library: compiles oslo.cpp into a shared library next to this file.
+    Returns:
+        path: path of the built library, or None if no compiler is available
+              or compilation failed.
+    '''
+
+    compiler = os.environ.get('CXX') or shutil.which('c++') or shutil.which('g++')
+    if compiler is None:
+        return None
+    path = os.path.join(directory, library_names()[0])
+    if sys.platform.startswith('win'):
+        # MinGW-w64 g++, the runtime is linked statically so the dll stands alone
+        command = [compiler, '-O3', '-std=c++11', '-shared', '-static', '-pthread', '-o', path, source]
+    else:
+        command = [compiler, '-O3', '-std=c++11', '-shared', '-fPIC', '-pthread', '-o', path, source]
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return path
+
+def find_library(stale=False):
+    # returns the path of an up to date compiled kernel if one exists, or of
+    # any compiled kernel if stale is True
+    for name in library_names():
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            # rebuild libraries that are older than the source where possible
+            if (not stale and os.path.exists(source)
+                    and os.path.getmtime(path) < os.path.getmtime(source)):
+                continue
+            return path
+    return None
+
+def declare_functions(lib):
+    # sets the argument and return types of the kernel entry points, raising
+    # AttributeError if the library does not export one of them
+    lib.oslo.restype = None
+    lib.oslo.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_double, int_array,
+                         double_array, int_array, int_array, int_array, int_array, ctypes.c_uint64]
+    lib.oslo_init.restype = None
+    lib.oslo_init.argtypes = [ctypes.c_int, ctypes.c_double, uint64_array, uint64_array]
+    lib.oslo_chunk.restype = None
+    lib.oslo_chunk.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_double, int64_array,
+                               int64_array, int64_array, uint8_array, uint64_array, 
+                               uint64_array, int_array, uint_array]
+    lib.oslo_chunk_instrumented.restype = None
+    lib.oslo_chunk_instrumented.argtypes = lib.oslo_chunk.argtypes + [int64_array, double_array]
+    lib.oslo_jobs.restype = None
+    # heights is passed as a void pointer as it may be NULL
+    lib.oslo_jobs.argtypes = [ctypes.c_int, int_array, ctypes.c_int, ctypes.c_double, uint64_array,
+                              ctypes.c_int, ctypes.c_int, int64_array, int64_array, ctypes.c_void_p,
+                              uint_array, int64_array]
+    lib.oslo_skip.restype = None
+    lib.oslo_skip.argtypes = [ctypes.c_longlong, ctypes.c_int, ctypes.c_double, int64_array, int64_array,
+                              int64_array, uint8_array, uint64_array, uint64_array]
+    lib.oslo_transient.restype = None
+    lib.oslo_transient.argtypes = [ctypes.c_int, ctypes.c_double, int64_array, int64_array,
+                                   int64_array, uint8_array, uint64_array, uint64_array]
+
+def load_library(build=True):
+    '''
+    load_library: loads the compiled Oslo kernel, building it from oslo.cpp
+    if required.
+    Args:
+        build: compile oslo.cpp if no library is found.
+    Returns:
+        lib: ctypes library, or None if the kernel is not available on
+             this system.
+    '''
+
+    global _library, _load_attempted
+    if _library is not None or _load_attempted:
+        return _library
+    _load_attempted = True
+
+    path = find_library()
+    if path is None and build:
+        path = build_library()
+    if path is None:
+        # an out of date library is still loaded if it cannot be rebuilt
+        path = find_library(stale=True)
+    if path is None:
+        warnings.warn('Compiled Oslo kernel not found and oslo.cpp could not be built; '
+                      'run make (make oslo.dll with MinGW-w64 on Windows), see the readme.')
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError as error:
+        warnings.warn('Compiled Oslo kernel {} could not be loaded: {}'.format(path, error))
+        return None
+
+    try:
+        declare_functions(lib)
+    except AttributeError:
+        # a library built from an older oslo.cpp lacks some entry points, so
+        # the kernel is treated as unavailable
+        warnings.warn('Compiled Oslo kernel {} was built from an older oslo.cpp, '
+                      'rebuild it with make.'.format(path))
+        return None
+    _library = lib
+    return _library
+
+def available():
+    # checks whether the compiled kernel can be used
+    return load_library() is not None
+
+def kernel_library():
+    # the loaded kernel library, raising an error if it is not available
+    lib = load_library()
+    if lib is None:
+        raise OSError('Compiled Oslo kernel is not available, run make to build it.')
+    return lib
+
+class Kernel_System:
+    '''
+    Kernel_System class for an Oslo model system run by the compiled kernel.
+    The pile, generator and iteration count are held in numpy arrays shared
+    with the kernel, so a run can be carried out in chunks, checkpointed and
+    resumed. Mirrors the interface of oslo.System. As in oslo.System the pile
+    is held as the slope of each site and the height of site 1, and the
+    threshold gradients are packed one bit per site.
+    Important methods:
+        iterate: iterates the model through required number of iterations
+    '''
+    
+    def __init__(self, L, p=0.5, seed=None, instrument=False):
+        
+        '''
+        Args:
+            L: system size e.g. number of sites.
+            p: probability of a threshold gradient of 1.
+            seed: int, None or np.random.SeedSequence used to seed the kernel's
+                  xoshiro256** generator. None draws fresh entropy, which
+                  is recorded in self.seed.
+            instrument: if True, iterate runs the kernel's separate instrumented
+                        entry point, adding its counters and phase times to
+                        self.counters (instrumentation.Counters). The transient
+                        run by run_to_recurrence is not counted.
+        '''
+        
+        self.lib = kernel_library()
+        self.L = L
+        self.p = p
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed # seed sequence the run can be repeated from
+        self.rng_state = seed.generate_state(4, np.uint64) # generator state
+        self.z = np.zeros(L, np.uint8) # slope at each site
+        # threshold gradient of each site, bit set for a threshold of 2
+        self.thresholds = np.zeros((L + 63) // 64, np.uint64)
+        self.height_state = np.zeros(1, np.int64) # height of site 1
+        self.count_state = np.zeros(1, np.int64) # counts number of iterations
+        self.t_c_state = np.full(1, -1, np.int64) # negative until crossover
+        self.origin = 0 # iteration stored at index 0 of heights and avalanche_sizes
+        self.counters = None # hot path counters of an instrumented system
+        if instrument:
+            self.counters = Counters()
+            self.run_chunk = self.run_chunk_counted
+    
+    @property
+    def h(self):
+        # height at each site, height at L+1=0
+        h = np.zeros(self.L + 1, np.int64)
+        h[:-1] = np.cumsum(self.z[::-1])[::-1]
+        return h
+    
+    @property
+    def zth(self):
+        # threshold gradient of each site, unpacked from the threshold bits
+        bits = np.unpackbits(self.thresholds.view(np.uint8), bitorder='little')
+        return 1 + bits[:self.L].astype(np.intc)
+    
+    @property
+    def count(self):
+        return int(self.count_state[0])
+    
+    @property
+    def t_c(self):
+        # crossover time, None if not yet reached
+        return None if self.t_c_state[0] < 0 else int(self.t_c_state[0])
+    
+    @property
+    def recurrent(self):
+        return self.t_c is not None
+    
+    def run_to_recurrence(self):
+        # runs the transient phase in the kernel without storing anything
+        self.lib.oslo_transient(self.L, self.p, self.count_state, self.t_c_state, 
+                                self.height_state, self.z, self.thresholds, self.rng_state)
+    
+    def fast_forward(self):
+        # builds a recurrent configuration directly, see oslo.System.fast_forward
+        self.z[:] = self.zth
+        self.height_state[:] = np.sum(self.z)
+        self.t_c_state[:] = 0
+        self.lib.oslo_skip(burn_in_grains(self.L), self.L, self.p, self.count_state, self.t_c_state,
+                           self.height_state, self.z, self.thresholds, self.rng_state)
+    
+    def iterate(self, N=10**4, stream=False, chunk_size=10**6, checkpoint=None, store=None,
+                recurrent_only=False, fast_forward=False, resume=False):
+        '''
+        Iterates the model N times, see oslo.System.iterate.
+        
+        Args:
+            N: number of iterations, or of recurrent samples if recurrent_only.
+            stream: if True, only running statistics of the recurrent phase
+                    are kept (self.statistics).
+            chunk_size: number of iterations per kernel call when streaming or
+                        checkpointing.
+            checkpoint: file name of a checkpoint to resume from and rewrite
+                        after every chunk.
+            store: data_store.Data_Store which the recurrent data is appended
+                   to after every chunk.
+            recurrent_only: if True, the transient phase is run in the kernel 
+                            without storing anything and N samples are taken
+                            after t_c.
+            fast_forward: if True, the transient phase is skipped by building a
+                          recurrent configuration directly and running its
+                          burn-in in the kernel (oslo_skip), implies
+                          recurrent_only. t_c is then 0.
+            resume: if True, the model continues from its current pile and
+                    thresholds instead of starting from an empty pile.
+        '''
+        self.N = N
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_checkpoint(checkpoint, stream, store)
+        else:
+            if stream:
+                self.statistics = Running_Statistics()
+            else:
+                self.heights = np.zeros(N, np.intc)
+                self.avalanche_sizes = np.zeros(N, np.uintc)
+            if resume:
+                self.origin = self.count # samples are only stored from here
+            else:
+                # sets initial threshold gradients
+                self.lib.oslo_init(self.L, self.p, self.thresholds, self.rng_state)
+                if self.counters is not None: # a draw for each initial threshold
+                    self.counters.counts[[RNG_DRAWS, RNG_CALLS]] += self.L
+                if fast_forward:
+                    self.fast_forward()
+                elif recurrent_only:
+                    self.run_to_recurrence()
+                if recurrent_only or fast_forward:
+                    self.origin = self.count # samples are only stored from here
+        if stream: # buffers are only one chunk long when streaming
+            self.heights = np.zeros(min(N, chunk_size), np.intc)
+            self.avalanche_sizes = np.zeros(min(N, chunk_size), np.uintc)
+        
+        chunked = stream or checkpoint is not None or store is not None
+        step = min(N, chunk_size) if chunked else N
+        end = self.origin + N
+        for start in range(self.count, end, max(step, 1)):
+            n = min(step, end - start)
+            offset = 0 if stream else start - self.origin # index of the chunk in the buffers
+            heights = self.heights[offset:offset + n]
+            avalanche_sizes = self.avalanche_sizes[offset:offset + n]
+            self.run_chunk(n, heights, avalanche_sizes)
+            if self.recurrent and (stream or store is not None):
+                record_start = timer()
+                # fold the recurrent part of the chunk into the statistics and store
+                first = max(self.t_c - start, 0)
+                if stream:
+                    self.statistics.update(heights[first:], avalanche_sizes[first:])
+                if store is not None:
+                    if store.metadata.get('t_c') is None:
+                        store.update_metadata(t_c=self.t_c)
+                    store.append(heights[first:], avalanche_sizes[first:])
+                if self.counters is not None:
+                    self.counters.times[RECORD] += timer() - record_start
+            if checkpoint is not None:
+                self.save_checkpoint(checkpoint, stream, store)
+        
+        if stream: # buffers only hold the final chunk so are discarded
+            self.heights = None
+            self.avalanche_sizes = None
+    
+    def run_chunk(self, n, heights, avalanche_sizes):
+        # runs n iterations in the kernel, writing their output to the buffers
+        self.lib.oslo_chunk(n, self.L, self.p, self.count_state, self.t_c_state, self.height_state,
+                            self.z, self.thresholds, self.rng_state, heights, avalanche_sizes)
+    
+    def run_chunk_counted(self, n, heights, avalanche_sizes):
+        # run_chunk in the instrumented kernel entry point
+        self.lib.oslo_chunk_instrumented(n, self.L, self.p, self.count_state, self.t_c_state,
+                                         self.height_state, self.z, self.thresholds, self.rng_state,
+                                         heights, avalanche_sizes, self.counters.counts,
+                                         self.counters.times)
+    
+    def save_checkpoint(self, path, stream=False, store=None):
+        # saves the pile state, generator state and outputs so far
+        state = {'L': self.L, 'p': self.p, 'N': self.N, 'stream': stream,
+                 'count': self.count_state, 't_c': self.t_c_state, 'z': self.z, 
+                 'thresholds': self.thresholds, 'rng_state': self.rng_state, 'origin': self.origin,
+                 'seed': seed_record(self.seed), 'store_n': -1 if store is None else len(store)}
+        if stream:
+            state.update(self.statistics.state())
+        else:
+            state['heights'] = self.heights[:self.count - self.origin]
+            state['avalanche_sizes'] = self.avalanche_sizes[:self.count - self.origin]
+        save_checkpoint(path, state)
+    
+    def load_checkpoint(self, path, stream=False, store=None):
+        # restores a run saved by save_checkpoint, discarding any data appended
+        # to the store after the checkpoint was written
+        state = load_checkpoint(path)
+        check_checkpoint(state, L=self.L, p=self.p, N=self.N, stream=stream)
+        if 'seed' in state: # not recorded by older checkpoints
+            check_checkpoint(state, seed=seed_record(self.seed))
+        if store is not None and state['store_n'] >= 0:
+            store.truncate(int(state['store_n']))
+        self.count_state[:] = state['count']
+        self.t_c_state[:] = state['t_c']
+        self.origin = int(state.get('origin', 0))
+        if 'z' in state:
+            self.z[:] = state['z']
+            self.thresholds[:] = state['thresholds']
+        else: # checkpoints from before slopes were stored
+            self.z[:] = -np.diff(state['h'])
+            bits = np.zeros(len(self.thresholds) * 64, np.uint8)
+            bits[:self.L] = state['zth'] - 1
+            self.thresholds[:] = np.packbits(bits, bitorder='little').view(np.uint64)
+        self.height_state[:] = np.sum(self.z)
+        self.rng_state[:] = state['rng_state']
+        if stream:
+            self.statistics = Running_Statistics()
+            self.statistics.load_state(state)
+        else:
+            self.heights = np.zeros(self.N, np.intc)
+            self.avalanche_sizes = np.zeros(self.N, np.uintc)
+            self.heights[:self.count - self.origin] = state['heights']
+            self.avalanche_sizes[:self.count - self.origin] = state['avalanche_sizes']
+    
+    def z_mean(self): 
+        # calculates average gradient of pile
+        return self.height_state[0] / self.L
+    
+    def t_c_theory(self):
+        # calculates theoretical crossover time
+        return (self.z_mean() / 2) * self.L**2 * (1. + 1. / self.L)
+    
+    def recurrent_start(self):
+        # index of the first recurrent sample, see oslo.System.recurrent_start
+        if self.t_c is None:
+            return len(self.heights)
+        return max(self.t_c - self.origin, 0)
+    
+    def recurrent_s(self): 
+        # cuts off avalanche sizes at t_c for recurrent avalanche sizes
+        return self.avalanche_sizes[self.recurrent_start():]
+    
+    def recurrent_h(self):
+        # cuts of height history at t_c for recurrent heights
+        return self.heights[self.recurrent_start():]
+
+def run_kernel_jobs(L, N, p, seeds, recurrent_only=False, threads=None, store_heights=True):
+    '''
+    run_kernel_jobs: runs a batch of independent systems in a single call of
+    the compiled kernel, which spreads them over threads inside the library.
+    ctypes releases the GIL during the call, and the outputs are written to
+    contiguous arrays allocated once for the whole batch. Each job gives the
+    same output as Kernel_System(L[j], p, seeds[j]).iterate(N, recurrent_only=...).
+    Args:
+        L: array-like, system size of each job. Jobs are started in order,
+           so the largest should come first.
+        N: number of iterations, or of recurrent samples if recurrent_only.
+        p: probability of a threshold gradient of 1.
+        seeds: seed of each job, as for Kernel_System.
+        recurrent_only: if True, N samples are taken after t_c.
+        threads: number of threads, default the number of CPUs.
+        store_heights: if False only the mean and standard deviation of the
+                       recurrent heights are kept, not the height series.
+    Returns:
+        results: dict of 't_c' (list, None where not reached), 't_c_theory',
+                 'heights' (jobs x N, None unless store_heights),
+                 'avalanche_sizes' (jobs x N), 'first' (index of the first
+                 recurrent sample of each job), 'mean_h' and 'sd_h' (of the
+                 recurrent heights).
+    '''
+
+    lib = kernel_library()
+    L = np.ascontiguousarray(L, np.intc)
+    n_jobs = len(L)
+    rng_states = np.array([(seed if isinstance(seed, np.random.SeedSequence) 
+                            else np.random.SeedSequence(seed)).generate_state(4, np.uint64)
+                           for seed in seeds], np.uint64).reshape(n_jobs, 4)
+    t_c = np.zeros(n_jobs, np.int64)
+    height = np.zeros(n_jobs, np.int64)
+    heights = np.zeros((n_jobs, N), np.intc) if store_heights else None
+    avalanche_sizes = np.zeros((n_jobs, N), np.uintc)
+    h_sums = np.zeros((n_jobs, 2), np.int64)
+    lib.oslo_jobs(n_jobs, L, N, p, rng_states, int(recurrent_only), threads or os.cpu_count() or 1,
+                  t_c, height, None if heights is None else heights.ctypes.data, avalanche_sizes, h_sums)
+
+    # as Kernel_System.recurrent_s, recurrent samples start at t_c unless
+    # only recurrent samples were taken
+    first = np.where(t_c < 0, N, 0 if recurrent_only else t_c)
+    n = N - first
+    # nan without recurrent samples, as np.mean and np.std of an empty array
+    mean_h = np.full(n_jobs, np.nan)
+    sd_h = np.full(n_jobs, np.nan)
+    for j in range(n_jobs):
+        if n[j] > 0:
+            # the sums are exact integers, so the variance is computed exactly
+            total, squares = int(h_sums[j, 0]), int(h_sums[j, 1])
+            mean_h[j] = total / int(n[j])
+            sd_h[j] = np.sqrt((int(n[j]) * squares - total**2) / int(n[j])**2)
+    z_mean = height / L
+    return {'t_c': [None if t < 0 else int(t) for t in t_c],
+            't_c_theory': (z_mean / 2) * L.astype(np.float64)**2 * (1. + 1. / L),
+            'heights': heights, 'avalanche_sizes': avalanche_sizes, 'first': first,
+            'mean_h': mean_h, 'sd_h': sd_h}
+
+def oslo(N, L, p, seed=None):
+    '''
+    oslo: runs the compiled Oslo kernel for a single system size.
+    Args:
+        N: number of iterations.
+        L: system size.
+        p: probability of setting threshold gradients to 1.
+        seed: seed for the kernel's generator, None draws fresh entropy.
+    Returns:
+        t_c: crossover time.
+        t_c_theory: theoretical crossover time.
+        heights: array-like, system height after each iteration.
+        avalanche_sizes: array-like, avalanche size of each iteration.
+    '''
+
+    system = Kernel_System(L, p, seed)
+    system.iterate(N)
+    # crossover time is reported as 0 if it was not reached, as by the dll
+    t_c = 0 if system.t_c is None else system.t_c
+    return t_c, system.t_c_theory(), system.heights, system.avalanche_sizes
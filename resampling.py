@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from running_statistics import histogram_moments
+from avalanche_probability_analysis import moment_exponents
+from height_analysis import fit_scaling_correction
+
+def block_sums(data, n_blocks, k_max):
+    '''
+    block_sums: splits a recurrent time series into consecutive blocks and
+    reduces each block to the sums of x^k, k=0..k_max, from its histogram.
+    Args:
+        data: array-like of non-negative integers, e.g. recurrent heights or
+              avalanche sizes (a Data_Store memory map is read block by block).
+        n_blocks: int, number of blocks.
+        k_max: int, highest power to sum.
+    Returns:
+        sums: array indexed [b, k], the sum of x^k over block b.
+    '''
+
+    edges = np.linspace(0, len(data), n_blocks + 1).astype(np.int64)
+    sums = np.zeros((n_blocks, k_max + 1), np.longdouble)
+    for b in range(n_blocks):
+        block = np.asarray(data[edges[b]:edges[b + 1]], np.int64)
+        sums[b] = histogram_moments(np.bincount(block), k_max)
+    return sums
+
+class Resampling_Analysis:
+    '''
+    Resampling_Analysis: error estimates for the critical exponents D, t_s and
+    the corrections to scaling parameters a_0, omega_1 from a single long run
+    of each system size, rather than from the spread over M independent runs.
+    The recurrent series are cut into blocks which are each reduced once to
+    their sums of h and s^k, so a resample only reweights these block sums and
+    costs O(blocks) rather than O(N). Blocks should be much longer than the
+    correlation time of the series.
+    Important methods:
+        bootstrap: estimates from block bootstrap resamples.
+        jackknife: estimates from delete-one-block jackknife resamples.
+        errors: mean and standard error of each estimate.
+    '''
+
+    def __init__(self, L, recurrent_h_data, recurrent_s_data, n_blocks=100, k_max=4):
+
+        '''
+        Args:
+            L: array-like, system sizes.
+            recurrent_h_data: recurrent height series of each system size.
+            recurrent_s_data: recurrent avalanche size series of each system size.
+            n_blocks: int, number of blocks each series is cut into.
+            k_max: int, highest moment of the avalanche size used for D, t_s.
+        '''
+
+        self.L = L
+        self.n_blocks = n_blocks
+        self.k_max = k_max
+        # block sums indexed [i, b, k] for system size L[i]
+        self.h_sums = np.array([block_sums(h, n_blocks, 1) for h in recurrent_h_data])
+        self.s_sums = np.array([block_sums(s, n_blocks, k_max) for s in recurrent_s_data])
+
+    def estimate(self, weights):
+        '''
+        estimate: critical exponents from reweighted blocks.
+        Args:
+            weights: array indexed [r, i, b], the number of times block b of
+                     system size L[i] appears in resample r.
+        Returns:
+            D, t_s, a_0, omega_1: arrays of estimates for each resample.
+        '''
+
+        weights = np.asarray(weights, np.longdouble)
+        h = np.einsum('rib,ibk->rik', weights, self.h_sums)
+        s = np.einsum('rib,ibk->rik', weights, self.s_sums)
+        mean_h = np.float64(h[..., 1] / h[..., 0])
+        # moments indexed [r, k, i]
+        moments = np.float64(s / s[..., :1]).transpose(0, 2, 1)
+        D, t_s = moment_exponents(self.L, moments, range(1, self.k_max + 1))
+        min_r, a_0, slope, intercept, log_mean_h, omega_1 = fit_scaling_correction(self.L, mean_h)
+        return D, t_s, a_0, omega_1
+
+    def full(self):
+        # estimates from the complete series
+        return tuple(x[0] for x in self.estimate(np.ones((1, len(self.L), self.n_blocks))))
+
+    def bootstrap(self, R=1000, seed=None):
+        '''
+        bootstrap: estimates from R block bootstrap resamples, each system size
+        being resampled independently.
+        Args:
+            R: int, number of resamples.
+            seed: seed for the random number generator which picks the blocks.
+        Returns:
+            D, t_s, a_0, omega_1: arrays of R estimates.
+        '''
+
+        rng = np.random.default_rng(seed)
+        B = self.n_blocks
+        picks = rng.integers(0, B, (R, len(self.L), B))
+        # number of times each block is picked
+        offsets = np.arange(R * len(self.L))[:, np.newaxis] * B
+        weights = np.bincount((picks.reshape(-1, B) + offsets).ravel(), minlength=R * len(self.L) * B)
+        return self.estimate(weights.reshape(R, len(self.L), B))
+
+    def jackknife(self):
+        '''
+        jackknife: estimates with each block of every system size left out in
+        turn.
+        Returns:
+            D, t_s, a_0, omega_1: arrays of len(L) * n_blocks estimates,
+            indexed [i * n_blocks + b] for block b of system size L[i] left out.
+        '''
+
+        B = self.n_blocks
+        n = len(self.L)
+        weights = np.ones((n * B, n, B))
+        weights.reshape(n * B, n * B)[np.arange(n * B), np.arange(n * B)] = 0
+        return self.estimate(weights)
+
+    def errors(self, method='bootstrap', **kwargs):
+        '''
+        errors: estimates of D, t_s, a_0 and omega_1 with their standard errors.
+        Args:
+            method: 'bootstrap' or 'jackknife'.
+            kwargs: passed on to bootstrap.
+        Returns:
+            results: list of (estimate, standard error) for D, t_s, a_0, omega_1.
+        '''
+
+        if method == 'bootstrap':
+            resamples = self.bootstrap(**kwargs)
+            sd = [np.std(x) for x in resamples]
+        elif method == 'jackknife':
+            resamples = self.jackknife()
+            # each system size is an independent series, so the jackknife
+            # variances of the system sizes add
+            B = self.n_blocks
+            sd = []
+            for x in resamples:
+                x = x.reshape(len(self.L), B)
+                deviation = x - np.mean(x, axis=1, keepdims=True)
+                sd.append(np.sqrt(np.sum((B - 1) / B * np.sum(deviation**2, axis=1))))
+        else:
+            raise ValueError('Unknown resampling method {}.'.format(method))
+
+        results = list(zip(self.full(), sd))
+        print("Critical exponents from {} resampling of {} blocks:".format(method, self.n_blocks))
+        for name, (value, error) in zip(('D', 't_s', 'a_0', 'omega_1'), results):
+            print("{}={} +- {}".format(name, value, error))
+        return results
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import zipfile
+import numpy as np
+
+class Result_Cache:
+    '''
+    Result_Cache: content-addressed on-disk cache of simulation results. Each
+    result is stored as a .npz file named by a hash of the parameters which
+    produced it, e.g. (engine, L, N, p, seed). The cache is bounded in size and
+    evicts the least recently used results first.
+    Important methods:
+        key: hashes a set of parameters into a cache key.
+        get: returns the result stored under a key, or None on a miss.
+        put: stores a result under a key, evicting old results if required.
+    '''
+
+    version = 1 # bump to invalidate results from older versions of the model
+
+    def __init__(self, directory='data/cache', max_bytes=4 * 1024**3):
+
+        '''
+        Args:
+            directory: directory holding the cached results.
+            max_bytes: maximum total size of the cached results.
+        '''
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, **params):
+        # hash of the parameters, independent of their order
+        params['version'] = self.version
+        text = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        '''
+        get: returns the result stored under key, or None if there is none.
+        An unreadable entry, e.g. one truncated by a full disk, is removed
+        and treated as a miss.
+        Returns:
+            result: dict of arrays, scalars are returned as 0-d arrays.
+        '''
+
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {name: data[name] for name in data.files}
+            os.utime(path) # mark as recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return result
+
+    def put(self, key, result):
+        '''
+        put: stores a result under key and evicts the least recently used
+        results until the cache fits in max_bytes.
+        Args:
+            key: cache key from key().
+            result: dict of arrays and scalars.
+        '''
+
+        path = self.path(key)
+        # write to a temporary file first so readers never see a partial result,
+        # named per process as several workers may share the cache
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez(f, **result)
+        os.replace(temporary, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # removes the least recently used results until the cache fits
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError: # removed by another process
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        # removes every cached result
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.directory, name))
@@ -1,20 +1,284 @@
 # -*- coding: utf-8 -*-
-import ctypes
+import os
+import warnings
 import numpy as np
-import numpy.ctypeslib as ctl
 import oslo as oslo
+import oslo_kernel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from oslo_batch import Batch_System
+from running_statistics import Running_Statistics
+from data_store import Data_Store, store_path
+from checkpoint import seed_record
 from timeit import default_timer as timer
+
+def seed_sequence(seed):
+    '''
+    seed_sequence: root SeedSequence from which the random streams of a run 
+    are derived.
+    Args:
+        seed: int, None or np.random.SeedSequence. None draws fresh entropy.
+    '''
+    
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+# run index of the batch mode streams, beyond any run index of the single runs
+# so that they never share a stream, and fixed so that replica m of a batch
+# does not depend on M
+batch_stream = 2**32
+
+def job_seed_sequence(root, m, l):
+    # independent random stream for run m of system size l, equivalent to 
+    # spawning child m of the root sequence and then child l of that
+    return np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + (m, l))
+
+def check_sizes(L):
+    # the random streams are keyed on the system size so that a size gets the
+    # same stream whatever other sizes are run with it, so a repeated size
+    # would repeat the same run
+    repeated = sorted({l for l in L if list(L).count(l) > 1})
+    if repeated:
+        raise ValueError('System sizes {} are repeated and would get identical random streams, '
+                         'use run_oslo_multi for independent runs.'.format(repeated))
+
+def check_mode(mode):
+    # falls back to the python model if the compiled kernel cannot be loaded
+    if mode == 'cpp' and not oslo_kernel.available():
+        warnings.warn('Compiled Oslo kernel not available, running in python mode.')
+        return 'python'
+    return mode
+
+def run_jobs(function, jobs, workers=None):
+    '''
+    run_jobs: runs function(*args) for every job, optionally over a process pool.
+    Args:
+        function: module level function to run for each job.
+        jobs: list of (key, args) tuples, submitted in the order given so the 
+              most expensive jobs should come first.
+        workers: number of worker processes, None or 1 runs the jobs in series.
+    Returns:
+        results: dict mapping each job key to the return value of function.
+    '''
+    
+    results = {}
+    if workers is None or workers <= 1:
+        for key, args in jobs:
+            results[key] = function(*args)
+        return results
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, *args): key for key, args in jobs}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+def fold_statistics(recurrent_h, recurrent_s):
+    # running statistics of recurrent data which has already been stored
+    statistics = Running_Statistics()
+    statistics.update(recurrent_h, recurrent_s)
+    return statistics
+
+def checkpoint_path(directory, mode, N, l, p, m=0):
+    # checkpoint file name for run m of system size l
+    if directory is None:
+        return None
+    return os.path.join(directory, 'oslo_{}_{}_{}_{}_{}.npz'.format(mode, l, N, p, m))
+
+def pack_result(result, stream, seed):
+    # arrays to store in the result cache for the output of run_system, with
+    # the seed sequence it was run from
+    heights, recurrent_h, recurrent_s, t_c, t_c_th = result
+    packed = {'t_c': -1 if t_c is None else t_c, 't_c_th': t_c_th, 'seed': seed_record(seed)}
+    if stream:
+        packed.update(recurrent_s.state())
+    else:
+        packed['heights'] = heights
+        packed['recurrent_s'] = recurrent_s
+    return packed
+
+def unpack_result(packed, stream, recurrent_only=False):
+    # output of run_system from arrays stored in the result cache
+    t_c = None if packed['t_c'] < 0 else int(packed['t_c'])
+    t_c_th = float(packed['t_c_th'])
+    if stream:
+        statistics = Running_Statistics()
+        statistics.load_state(packed)
+        return None, statistics, statistics, t_c, t_c_th
+    heights = packed['heights']
+    # no samples are recurrent if t_c was not reached, as in System.recurrent_h
+    recurrent_h = heights if recurrent_only else heights[len(heights) if t_c is None else t_c:]
+    return heights, recurrent_h, packed['recurrent_s'], t_c, t_c_th
+
+def cache_key(cache, mode, N, l, p, seed, stream, recurrent_only):
+    # result cache key of one system size, seed must be a SeedSequence
+    return cache.key(engine=mode, L=l, N=N, p=p, seed=seed.entropy, 
+                     spawn_key=list(seed.spawn_key), stream=stream, 
+                     recurrent_only=recurrent_only)
+
+def run_system(mode, N, l, p, seed=None, stream=False, checkpoint=None, cache=None,
+               recurrent_only=False):
+    '''
+    run_system: Runs the oslo model for a single system size.
+    Params:
+        mode: 'cpp' or 'python', see run_oslo.
+        N: Number of iterations.
+        l: system size.
+        p: probability of setting threshold gradients to 1.
+        seed: seed or SeedSequence for the random number generator.
+        stream: if True, the recurrent data is returned as Running_Statistics
+                and heights is None.
+        checkpoint: checkpoint file to resume from and write after each chunk.
+        cache: Result_Cache to look the result up in and store it to, keyed
+               on (mode, l, N, p, seed, stream, recurrent_only). seed must be a
+               SeedSequence.
+        recurrent_only: if True, N recurrent samples are taken after t_c and 
+                        the transient phase is not stored, so heights only
+                        holds the recurrent heights.
+    Returns:
+        heights, recurrent_h, recurrent_s, t_c, t_c_th for this system size.
+    '''
+    
+    if cache is not None:
+        key = cache_key(cache, mode, N, l, p, seed, stream, recurrent_only)
+        packed = cache.get(key)
+        if packed is not None:
+            return unpack_result(packed, stream, recurrent_only)
+    
+    if mode == 'cpp':
+        system = oslo_kernel.Kernel_System(l, p, seed=seed)
+    elif mode == 'python':
+        system = oslo.System(l, p, seed=seed)
+    else:
+        raise ValueError('Unknown mode: {}'.format(mode))
+    
+    # iterate the system N times using method
+    system.iterate(N, stream=stream, checkpoint=checkpoint, recurrent_only=recurrent_only)
+    if stream:
+        result = None, system.statistics, system.statistics, system.t_c, system.t_c_theory()
+    else:
+        result = (system.heights, system.recurrent_h(), system.recurrent_s(), 
+                  system.t_c, system.t_c_theory())
+    
+    if cache is not None:
+        cache.put(key, pack_result(result, stream, seed))
+    return result
+
+def run_multi_job(mode, N, l, p, seed=None, stream=False, checkpoint=None, cache=None,
+                  recurrent_only=False):
+    # runs one system size for one of the runs in run_oslo_multi, returning 
+    # only the processed data so the full height history is not passed back
+    heights, recurrent_h, recurrent_s, t_c, t_c_th = run_system(mode, N, l, p, seed, stream, 
+                                                                checkpoint, cache, recurrent_only)
+    if stream:
+        return recurrent_h.mean_h(), recurrent_h.sd_h(), t_c, t_c_th, recurrent_s
+    return np.mean(recurrent_h), np.std(recurrent_h), t_c, t_c_th, recurrent_s
+
+def run_batch_job(M, N, l, p, seed=None, stream=False):
+    # advances all M runs of a system size together as one batch
+    system = Batch_System(l, M, p, seed=seed)
+    system.iterate(N)
+    t_c_theory = system.t_c_theory()
+    results = []
+    for m in range(M):
+        recurrent_h, recurrent_s = system.recurrent_h(m), system.recurrent_s(m)
+        if stream:
+            recurrent_s = fold_statistics(recurrent_h, recurrent_s)
+        results.append((np.mean(recurrent_h), np.std(recurrent_h), system.t_c[m], 
+                        t_c_theory[m], recurrent_s))
+    return results
    
-def run_oslo(mode, N, L, p):
+def run_threaded_jobs(N, L, p, seeds, threads, cache=None, recurrent_only=False, store_heights=True):
+    '''
+    run_threaded_jobs: runs the (system size, seed) jobs which are not in the
+    cache in one threaded call of the compiled kernel (oslo_kernel.run_kernel_jobs)
+    and stores their results in the cache.
+    Args:
+        N, p, recurrent_only: see run_oslo.
+        L: system size of each job, largest first.
+        seeds: SeedSequence of each job.
+        threads: number of kernel threads.
+        cache: result_cache.Result_Cache, or None.
+        store_heights: if False, the height series are not kept and each job
+                       returns the processed data of run_multi_job. Jobs are
+                       still cached with their heights when a cache is given.
+    Returns:
+        results: list of (heights, recurrent_h, recurrent_s, t_c, t_c_th) of
+                 each job, or (mean_h, sd_h, t_c, t_c_th, recurrent_s) when
+                 store_heights is False.
+    '''
+    
+    results = [None] * len(L)
+    keys = [None] * len(L)
+    if cache is not None:
+        for j, (l, seed) in enumerate(zip(L, seeds)):
+            keys[j] = cache_key(cache, 'cpp', N, l, p, seed, False, recurrent_only)
+            packed = cache.get(keys[j])
+            if packed is not None:
+                results[j] = unpack_result(packed, False, recurrent_only)
+                if not store_heights:
+                    heights, recurrent_h, recurrent_s, t_c, t_c_th = results[j]
+                    results[j] = np.mean(recurrent_h), np.std(recurrent_h), t_c, t_c_th, recurrent_s
+    
+    missing = [j for j in range(len(L)) if results[j] is None]
+    if missing:
+        keep = store_heights or cache is not None # heights are cached
+        output = oslo_kernel.run_kernel_jobs([L[j] for j in missing], N, p, [seeds[j] for j in missing],
+                                             recurrent_only, threads, keep)
+        for k, j in enumerate(missing):
+            first, t_c, t_c_th = output['first'][k], output['t_c'][k], output['t_c_theory'][k]
+            recurrent_s = output['avalanche_sizes'][k, first:]
+            if keep:
+                heights = output['heights'][k]
+                result = heights, heights[first:], recurrent_s, t_c, t_c_th
+                if cache is not None:
+                    cache.put(keys[j], pack_result(result, False, seeds[j]))
+            if not store_heights:
+                result = output['mean_h'][k], output['sd_h'][k], t_c, t_c_th, recurrent_s
+            results[j] = result
+    return results
+
+def run_oslo(mode, N, L, p, seed=None, workers=None, stream=False, checkpoint_dir=None,
+             cache=None, recurrent_only=False, threads=None):
     '''
     run_oslo: Runs the oslo model for a single run.
     Params: 
-        mode: 'cpp' runs the algorithm in C++ for a significant speedup,
+        mode: 'cpp' runs the algorithm in C++ for a significant speedup
+              (falls back to 'python' if the compiled kernel is unavailable),
               'python' runs the algorithm in Python,
-              'use_data' loads existing data files from saved runs.
+              'use_data' loads existing data from saved runs, memory mapping
+              the data stores written by data_acquisition.py where they exist.
+              Sizes loaded from .npy files have None in recurrent_h_data
+              and t_c_data.
         N: Number of iterations.
-        L: array-like, system sizes to run the model for. 
+        L: array-like, system sizes to run the model for, without repeats.
         p: probability of setting threshold gradients to 1.
+        seed: seed for the random number generators, each system size gets an
+              independent stream spawned from it. None draws fresh entropy,
+              which is printed so that the run can be repeated.
+        workers: number of processes to spread the system sizes over, None
+                 runs them in series. Scripts using workers should guard
+                 their entry point with if __name__ == '__main__'.
+        stream: if True, only running statistics of the recurrent phase are
+                kept for each system size. recurrent_h_data and recurrent_s_data
+                then both hold the Running_Statistics of each system size, which
+                the analysis classes accept, and heights_data holds None.
+        checkpoint_dir: directory for checkpoints of each system size. Runs are
+                        carried out in chunks, checkpointed after every chunk
+                        and resumed from any checkpoint found.
+        cache: result_cache.Result_Cache. The result for each system size is
+               returned from the cache if it holds one for the same mode, N, p,
+               seed and stream, and stored in it otherwise. Only used when a
+               seed is given, as unseeded runs cannot be repeated.
+        recurrent_only: if True, N is the number of recurrent samples taken
+                        after t_c for each system size. The transient phase is
+                        run without storing anything, so heights_data only
+                        holds the recurrent heights.
+        threads: number of threads for mode 'cpp'. If given, every system size
+                 is run in one call of the compiled kernel, which spreads them
+                 over threads with the GIL released, instead of over worker
+                 processes. The output is identical. Not used with stream or
+                 checkpoint_dir.
     
     Returns:
         heights_data: array-like, array containing arrays of system height 
@@ -35,54 +299,55 @@ def run_oslo(mode, N, L, p):
     t_c_data = []
     t_c_th_data = []
     
-    if mode == 'cpp':
-        # run for each system size specified
-        for l in L: 
-            
-            # initalise arrays to pass into c++ code for each system size
-            t_c = np.zeros(1, np.int)
-            t_c_theory = np.zeros(1, np.float)
-            h = np.zeros(l + 1, np.int)
-            zth = np.zeros(l, np.int)
-            heights = np.zeros(N, np.int)
-            avalanche_sizes = np.zeros(N, np.int)
-            
-            # load shared library dll source for c++ code
-            lib = ctypes.cdll.LoadLibrary('./oslo.dll')
-            py_oslo = lib.oslo        
-            py_oslo.restype = None
-            # pass python parameters into c++ types to call function in python
-            py_oslo(ctypes.c_int(N), ctypes.c_int(l), ctypes.c_double(p), ctl.as_ctypes(t_c),
-                    ctl.as_ctypes(t_c_theory), ctl.as_ctypes(h), ctl.as_ctypes(zth), 
-                    ctl.as_ctypes(heights), ctl.as_ctypes(avalanche_sizes))
+    check_sizes(L)
+    mode = check_mode(mode)
+    
+    if mode in ('cpp', 'python'):
+        # run for each system size specified, largest first so that the
+        # biggest system is not left running on its own at the end
+        root = seed_sequence(seed)
+        if seed is None:
+            print('Seed entropy: {}'.format(root.entropy))
+        cache = None if seed is None else cache
+        order = sorted(enumerate(L), key=lambda job: -job[1])
+        if mode == 'cpp' and threads and not stream and checkpoint_dir is None:
+            threaded = run_threaded_jobs(N, [l for i, l in order], p, 
+                                         [job_seed_sequence(root, 0, l) for i, l in order], 
+                                         threads, cache, recurrent_only)
+            results = {i: result for (i, l), result in zip(order, threaded)}
+        else:
+            jobs = [(i, (mode, N, l, p, job_seed_sequence(root, 0, l), stream,
+                         checkpoint_path(checkpoint_dir, mode, N, l, p), cache, recurrent_only)) 
+                    for i, l in order]
+            results = run_jobs(run_system, jobs, workers)
+        for i, l in enumerate(L):
+            heights, recurrent_h, recurrent_s, t_c, t_c_theory = results[i]
             # append filled arrays to relevant containers
             heights_data.append(heights)
-            recurrent_s_data.append(avalanche_sizes[t_c[0]:]) # cut off at t_c for recurrent data
-            recurrent_h_data.append(heights[t_c[0]:])
-            t_c_data.append(t_c[0])
-            t_c_th_data.append(t_c_theory[0])
-        
-    if mode == 'python':    
-        # run for each system size specified
-        for l in L:
-            # instantiate a system object and iterate N times using method
-            system = oslo.System(l)
-            system.iterate(N)
-            # populate relevant containers with system data
-            heights_data.append(system.heights)
-            recurrent_s_data.append(system.recurrent_s())
-            recurrent_h_data.append(system.recurrent_h())
-            t_c_data.append(system.t_c)
-            t_c_th_data.append(system.t_c_theory())
+            recurrent_h_data.append(recurrent_h)
+            recurrent_s_data.append(recurrent_s)
+            t_c_data.append(t_c)
+            t_c_th_data.append(t_c_theory)
     
     if mode == 'use_data':
         
         start = timer()
         # run for each system size specified
         for l in L:
-            # load up stored .npy files from previous runs
-            fname = 'data/avalanche_data/avalanche_sizes_{}_{}.npy'.format(l, N)
-            recurrent_s = (np.load(fname)).astype(int)
+            path = store_path('data/oslo_store', l, N)
+            if os.path.exists(path):
+                # memory map the data store written by data_acquisition.py
+                store = Data_Store(path)
+                recurrent_s = store.avalanche_sizes()
+                recurrent_h_data.append(store.heights())
+                t_c_data.append(store.metadata['t_c'])
+            else:
+                # load up stored .npy files from previous runs, which hold no
+                # heights or t_c, so None keeps the lists in line with L
+                fname = 'data/avalanche_data/avalanche_sizes_{}_{}.npy'.format(l, N)
+                recurrent_s = (np.load(fname)).astype(int)
+                recurrent_h_data.append(None)
+                t_c_data.append(None)
             print('Dataset size for L={}: {}'.format(l, len(recurrent_s)))
             # store temporary array in the permanent array
             recurrent_s_data.append(recurrent_s)
@@ -92,18 +357,42 @@ def run_oslo(mode, N, L, p):
     
     return heights_data, recurrent_h_data, recurrent_s_data, t_c_data, t_c_th_data
 
-def run_oslo_multi(mode, M, N, L, p):
+def run_oslo_multi(mode, M, N, L, p, seed=None, workers=None, stream=False, 
+                   checkpoint_dir=None, cache=None, recurrent_only=False, threads=None):
     '''
     run_oslo_multi: Run oslo model multiple times to calculate error on 
     calculated values.
     Params: 
         mode: 'cpp' runs the algorithm in C++ for a significant speedup,
               'python' runs the algorithm in Python,
+              'batch' runs all M realisations of each system size together
+              as one vectorised Python batch. This is a reference engine for
+              checking the others, not a fast path: it is usually slower
+              than 'python' unless M is large, and 'cpp' is much faster.
               'use_data' loads existing data files from saved runs.
         M: Number of runs to carry out.
         N: Number of iterations.
-        L: array-like, system sizes to run the model for. 
+        L: array-like, system sizes to run the model for, without repeats.
         p: probability of setting threshold gradients to 1.
+        seed: seed for the random number generators, each run and system size gets an
+              independent stream spawned from it, run 0 matches run_oslo 
+              with the same seed. None draws fresh entropy, which is printed.
+              In batch mode each replica gets its own stream, so replica m
+              does not depend on M.
+        workers: number of processes to spread the (L, run) jobs over, largest
+                 L first. None runs them in series.
+        stream: if True, s_data_multi holds the Running_Statistics of each 
+                run instead of the recurrent avalanche sizes.
+        checkpoint_dir: directory for checkpoints of each run and system size,
+                        see run_oslo. Not used in batch mode.
+        cache: result_cache.Result_Cache, see run_oslo. Run 0 shares its cache
+               entries with run_oslo called with the same seed, so it is reused
+               rather than simulated again. Not used in batch mode.
+        recurrent_only: if True, N recurrent samples are taken after t_c in
+                        each run, see run_oslo. Not used in batch mode.
+        threads: number of threads for mode 'cpp', see run_oslo. Every run of
+                 every system size is run in one call of the compiled kernel,
+                 keeping only the mean and standard deviation of the heights.
     Returns:
         height_mean_multi: array of array-like, contains arrays of mean recurrent height
                            for each system size, contained in an array for each run.
@@ -123,17 +412,52 @@ def run_oslo_multi(mode, M, N, L, p):
     height_sd_multi = []
     s_data_multi = []
     
+    check_sizes(L)
+    mode = check_mode(mode)
+    
+    if mode == 'use_data':
+        # loads the same stored data for every run
+        for m in range(M):
+            heights_data, recurrent_h_data, recurrent_s_data, t_c_data, t_c_th_data = run_oslo(mode, N, L, p)
+            height_mean_multi.append([])
+            height_sd_multi.append([])
+            t_c_multi.append(t_c_data)
+            t_c_th_multi.append(t_c_th_data)
+            s_data_multi.append(recurrent_s_data)
+        return height_mean_multi, height_sd_multi, t_c_multi, t_c_th_multi, s_data_multi
+    
+    root = seed_sequence(seed)
+    if seed is None:
+        print('Seed entropy: {}'.format(root.entropy))
+    cache = None if seed is None else cache
+    order = sorted(enumerate(L), key=lambda job: -job[1]) # largest L first
+    if mode == 'batch':
+        # all M runs of a system size are advanced together in one job, replica
+        # m drawing from child m of stream batch_stream
+        jobs = [(i, (M, N, l, p, job_seed_sequence(root, batch_stream, l), stream)) for i, l in order]
+        batch_results = run_jobs(run_batch_job, jobs, workers)
+        results = {(i, m): batch_results[i][m] for i in range(len(L)) for m in range(M)}
+    elif mode == 'cpp' and threads and not stream and checkpoint_dir is None:
+        jobs = [(i, m, l) for i, l in order for m in range(M)]
+        threaded = run_threaded_jobs(N, [l for i, m, l in jobs], p, 
+                                     [job_seed_sequence(root, m, l) for i, m, l in jobs], 
+                                     threads, cache, recurrent_only, store_heights=False)
+        results = {(i, m): result for (i, m, l), result in zip(jobs, threaded)}
+    else:
+        jobs = [((i, m), (mode, N, l, p, job_seed_sequence(root, m, l), stream,
+                          checkpoint_path(checkpoint_dir, mode, N, l, p, m), cache,
+                          recurrent_only)) 
+                for i, l in order for m in range(M)]
+        results = run_jobs(run_multi_job, jobs, workers)
+    
+    # populate output arrays using processed data from each run, in the order
+    # of the runs and system sizes requested
     for m in range(M):
-        # run oslo model M times
-        heights_data, recurrent_h_data, recurrent_s_data, t_c_data, t_c_th_data = run_oslo(mode, N, L, p)
-        # populate output arrays using processed data from each run
-        h_mean_data = [np.mean(h) for h in recurrent_h_data]
-        h_sd_data = [np.std(h) for h in recurrent_h_data]
-        height_mean_multi.append(h_mean_data)
-        height_sd_multi.append(h_sd_data)     
-        t_c_multi.append(t_c_data)
-        t_c_th_multi.append(t_c_th_data)
-        s_data_multi.append(recurrent_s_data)
+        run_results = [results[(i, m)] for i in range(len(L))]
+        height_mean_multi.append([r[0] for r in run_results])
+        height_sd_multi.append([r[1] for r in run_results])
+        t_c_multi.append([r[2] for r in run_results])
+        t_c_th_multi.append([r[3] for r in run_results])
+        s_data_multi.append([r[4] for r in run_results])
         
     return height_mean_multi, height_sd_multi, t_c_multi, t_c_th_multi, s_data_multi
-        
\ No newline at end of file
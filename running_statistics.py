@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+def histogram_moments(counts, k_max):
+    '''
+    histogram_moments: sums of s^k over integer data for every k=0..k_max in
+    one pass over its histogram, as sum(counts[s] * s^k). Only observed values
+    are used and the sums are accumulated in extended precision.
+    Args:
+        counts: array-like, histogram of the data e.g. np.bincount(data).
+        k_max: int, highest power to sum.
+    Returns:
+        sums: np.longdouble array, the sum of s^k for k=0..k_max.
+    '''
+    counts = np.asarray(counts)
+    values = np.flatnonzero(counts)
+    s = values.astype(np.longdouble)
+    term = counts[values].astype(np.longdouble) # counts[s] * s^k, starting at k=0
+    sums = np.zeros(k_max + 1, np.longdouble)
+    for k in range(k_max + 1):
+        sums[k] = np.sum(term)
+        term *= s
+    return sums
+
+class Running_Statistics:
+    '''
+    Running_Statistics: on-line accumulators for the recurrent heights and
+    avalanche sizes of an Oslo model run, so that memory depends on L rather
+    than on the number of iterations.
+    Keeps the Welford mean/variance of h, the raw moments of s for k=1..k_max
+    and integer histograms of h and s.
+    Important methods:
+        update: folds a chunk of heights and avalanche sizes into the accumulators.
+        mean_h, sd_h: mean and standard deviation of the recurrent height.
+        moment_s, moments_s: raw moments of the avalanche size.
+        h_distribution, s_distribution: observed values and their frequencies.
+    '''
+
+    def __init__(self, k_max=4):
+
+        '''
+        Args:
+            k_max: highest raw moment of the avalanche size to accumulate.
+        '''
+
+        self.k_max = k_max
+        self.n = 0 # number of samples accumulated
+        self.h_mean = 0. # running mean of the height
+        self.h_m2 = 0. # running sum of squared deviations from the mean height
+        self.s_sums = np.zeros(k_max + 1, np.longdouble) # sum of s^k for k=0..k_max
+        self.h_counts = np.zeros(0, np.int64) # histogram of heights
+        self.s_counts = np.zeros(0, np.int64) # histogram of avalanche sizes
+
+    def __len__(self):
+        return self.n
+
+    def add_counts(self, counts, data):
+        # adds the histogram of integer data to an existing histogram
+        new = np.bincount(data)
+        if len(new) > len(counts):
+            new[:len(counts)] += counts
+            return new
+        counts[:len(new)] += new
+        return counts
+
+    def update(self, heights, avalanche_sizes):
+        '''
+        update: folds a chunk of recurrent data into the accumulators.
+        Args:
+            heights: array-like, recurrent heights of the chunk.
+            avalanche_sizes: array-like, recurrent avalanche sizes of the chunk.
+        '''
+
+        n = len(heights)
+        if n == 0:
+            return
+        heights = np.asarray(heights, np.int64)
+        avalanche_sizes = np.asarray(avalanche_sizes, np.int64)
+
+        # combine the chunk mean and squared deviations with the running values
+        chunk_mean = np.mean(heights)
+        chunk_m2 = np.sum((heights - chunk_mean)**2)
+        total = self.n + n
+        delta = chunk_mean - self.h_mean
+        self.h_mean += delta * n / total
+        self.h_m2 += chunk_m2 + delta**2 * self.n * n / total
+        self.n = total
+
+        self.h_counts = self.add_counts(self.h_counts, heights)
+        # raw moments are accumulated from the chunk histogram of s
+        chunk_counts = np.bincount(avalanche_sizes)
+        self.s_sums += histogram_moments(chunk_counts, self.k_max)
+        self.s_counts = self.add_counts(self.s_counts, avalanche_sizes)
+
+    def state(self):
+        # accumulators as a dict of arrays, for saving in a checkpoint
+        return {'statistics_n': self.n, 'statistics_h_mean': self.h_mean, 
+                'statistics_h_m2': self.h_m2, 'statistics_s_sums': self.s_sums, 
+                'statistics_h_counts': self.h_counts, 'statistics_s_counts': self.s_counts}
+    
+    def load_state(self, state):
+        # restores the accumulators from a dict written by state
+        self.n = int(state['statistics_n'])
+        self.h_mean = float(state['statistics_h_mean'])
+        self.h_m2 = float(state['statistics_h_m2'])
+        self.s_sums = np.array(state['statistics_s_sums'], np.longdouble)
+        self.k_max = len(self.s_sums) - 1
+        self.h_counts = np.array(state['statistics_h_counts'], np.int64)
+        self.s_counts = np.array(state['statistics_s_counts'], np.int64)
+
+    def mean_h(self):
+        return self.h_mean
+
+    def sd_h(self):
+        # population standard deviation of the height, as np.std
+        return np.sqrt(self.h_m2 / self.n)
+
+    def moment_s(self, k):
+        # kth raw moment of the avalanche size
+        if k <= self.k_max:
+            return float(self.s_sums[k] / self.n)
+        return float(histogram_moments(self.s_counts, k)[k] / self.n)
+
+    def moments_s(self, k_max):
+        # raw moments of the avalanche size for k=0..k_max
+        if k_max <= self.k_max:
+            return np.float64(self.s_sums[:k_max + 1] / self.n)
+        return np.float64(histogram_moments(self.s_counts, k_max) / self.n)
+
+    def distribution(self, counts):
+        # observed values and their frequencies, as np.unique with return_counts
+        values = np.nonzero(counts)[0]
+        return values, counts[values]
+
+    def h_distribution(self):
+        return self.distribution(self.h_counts)
+
+    def s_distribution(self):
+        return self.distribution(self.s_counts)
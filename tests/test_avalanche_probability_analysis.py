@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from avalanche_probability_analysis import collapse_quality
+
+def curve(L, D=2.25, t_s=1.55):
+    # log binned pdf which collapses exactly for D, t_s
+    log_x = np.log(np.arange(1, 50)) + D * np.log(L) / 2
+    return log_x, -t_s * log_x
+
+def test_collapse_quality_perfect_collapse():
+    (x_1, y_1), (x_2, y_2) = curve(8), curve(16)
+    quality = collapse_quality([x_1, x_2], [y_1, y_2], np.log([8, 16]), 2.25, 1.55)
+    assert np.isfinite(quality) and quality < 1e-20
+
+def test_collapse_quality_fewer_than_two_curves():
+    x, y = curve(8)
+    empty = np.array([])
+    assert collapse_quality([x], [y], np.log([8]), 2.25, 1.55) == np.inf
+    assert collapse_quality([], [], [], 2.25, 1.55) == np.inf
+    assert collapse_quality([x, empty], [y, empty], np.log([8, 16]), 2.25, 1.55) == np.inf
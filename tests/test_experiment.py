@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+import os
+from experiment import load_spec, Experiment
+
+def test_crossover_stages_with_stream(tmp_path):
+    # the crossover stages need the full height series even when streaming
+    spec = load_spec(L=[8, 16, 32], N=5000, M=2, seed=1, stream=True, cache=None,
+                     output=str(tmp_path), format='png', stages=['crossover', 'crossover_multi'])
+    experiment = Experiment(spec)
+    experiment.run()
+    assert experiment.manifest['crossover']['figures']
+    for name in experiment.manifest['crossover']['figures']:
+        assert os.path.exists(os.path.join(experiment.directory, name))
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import logbin2018 as lb
+
+def loop_logbin(data, scale, zeros):
+    # the original per bin loop of logbin, as reference
+    count = np.bincount(data)
+    jmax = np.ceil(np.log(np.max(data)) / np.log(scale))
+    if zeros:
+        binedges = scale ** np.arange(jmax + 1)
+        binedges[0] = 0
+    else:
+        binedges = scale ** np.arange(1, jmax + 1)
+    binedges = np.unique(binedges.astype('int64'))
+    x = (binedges[:-1] * (binedges[1:] - 1)) ** 0.5
+    y = np.zeros_like(x)
+    count = count.astype('float')
+    for i in range(len(y)):
+        y[i] = np.sum(count[binedges[i]:binedges[i + 1]] / (binedges[i + 1] - binedges[i]))
+    return x, y / np.sum(count)
+
+def datasets():
+    rng = np.random.default_rng(0)
+    return [rng.zipf(1.5, n) % 10**6 for n in (10, 1000, 100000)] + [np.array([1, 1, 2, 7])]
+
+@pytest.mark.parametrize('zeros', [False, True])
+@pytest.mark.parametrize('scale', [1.2, 1.5, 2.])
+def test_logbin_matches_loop(scale, zeros):
+    # x is identical, y agrees to floating point rounding (see logbin_counts)
+    for data in datasets():
+        x, y = lb.logbin(data, scale, zeros)
+        x_loop, y_loop = loop_logbin(data, scale, zeros)
+        assert np.array_equal(x, x_loop)
+        np.testing.assert_allclose(y, y_loop, rtol=1e-12, atol=0)
+
+@pytest.mark.parametrize('zeros', [False, True])
+@pytest.mark.parametrize('scale', [1., 1.2, 2.])
+def test_logbin_counts_many_identical(scale, zeros):
+    data = datasets()
+    for (x, y), d in zip(lb.logbin_counts_many([np.bincount(d) for d in data], scale, zeros), data):
+        x_one, y_one = lb.logbin(d, scale, zeros)
+        assert np.array_equal(x, x_one) and np.array_equal(y, y_one)
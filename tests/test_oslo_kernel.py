@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import pytest
+import oslo_kernel
+
+def reset(monkeypatch, path):
+    monkeypatch.setattr(oslo_kernel, '_library', None)
+    monkeypatch.setattr(oslo_kernel, '_load_attempted', False)
+    monkeypatch.setattr(oslo_kernel, 'find_library', lambda stale=False: path)
+    monkeypatch.setattr(oslo_kernel, 'build_library', lambda: None)
+
+def test_missing_library_warns(monkeypatch):
+    reset(monkeypatch, None)
+    with pytest.warns(UserWarning, match='not found'):
+        assert oslo_kernel.load_library() is None
+
+def test_unloadable_library_warns(monkeypatch, tmp_path):
+    path = tmp_path / 'liboslo.so'
+    path.write_bytes(b'not a library')
+    reset(monkeypatch, str(path))
+    with pytest.warns(UserWarning, match='could not be loaded'):
+        assert oslo_kernel.load_library() is None
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+from result_cache import Result_Cache
+
+def test_round_trip(tmp_path):
+    cache = Result_Cache(str(tmp_path))
+    key = cache.key(engine='cpp', L=8)
+    assert cache.get(key) is None
+    cache.put(key, {'heights': np.arange(10), 't_c': 3})
+    result = cache.get(key)
+    assert np.array_equal(result['heights'], np.arange(10)) and result['t_c'] == 3
+
+def test_truncated_entry_is_a_miss(tmp_path):
+    cache = Result_Cache(str(tmp_path))
+    key = cache.key(engine='cpp', L=8)
+    cache.put(key, {'heights': np.arange(1000)})
+    path = cache.path(key)
+    for size in (os.path.getsize(path) // 2, 10, 0):
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+        assert cache.get(key) is None
+        assert not os.path.exists(path) # the bad entry is removed
+        cache.put(key, {'heights': np.arange(1000)})
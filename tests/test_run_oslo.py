@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from run_oslo import run_oslo_multi
+
+def test_batch_replica_independent_of_M():
+    # replica 0 draws from the same stream whatever the number of replicas
+    runs = [run_oslo_multi('batch', M, 3000, [16], 0.5, seed=1) for M in (2, 3)]
+    (mean_2, sd_2, t_c_2, t_c_th_2, s_2), (mean_3, sd_3, t_c_3, t_c_th_3, s_3) = runs
+    assert mean_2[0] == mean_3[0]
+    assert t_c_2[0] == t_c_3[0]
+    assert np.array_equal(s_2[0][0], s_3[0][0])